@@ -0,0 +1,74 @@
+"""Benchmark of pandas count metrics versus number of rows."""
+from typing import Callable, Dict, List
+
+import time
+import numpy as np
+import pandas as pd
+
+from metrics import CountBelowColumn, CountBelowValue, CountRatioBelow, CountValue, CountZeros
+
+
+METRICS = {
+    "CountZeros": CountZeros("x"),
+    "CountValue": CountValue("x", 1),
+    "CountBelowValue": CountBelowValue("y", 50),
+    "CountBelowColumn": CountBelowColumn("x", "y"),
+    "CountRatioBelow": CountRatioBelow("x", "y", "z"),
+}
+
+# Counts of the previous implementation, builtin sum() over boolean Series
+BUILTIN_SUM = {
+    "CountZeros": lambda df: sum(df["x"] == 0),
+    "CountValue": lambda df: sum(df["x"] == 1),
+    "CountBelowValue": lambda df: sum(df["y"] <= 50),
+    "CountBelowColumn": lambda df: sum(df["x"] <= df["y"]),
+    "CountRatioBelow": lambda df: sum(df["x"] / df["y"] <= df["z"]),
+}
+
+
+def make_table(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """Random table with integer valued x (with zeros), y in [0, 100) (with zeros) and z in [0, 1)."""
+    rng = np.random.default_rng(seed)
+    y = rng.random(n_rows) * 100
+    y[::1000] = 0
+    return pd.DataFrame({"x": rng.integers(0, 100, n_rows).astype(np.float64), "y": y, "z": rng.random(n_rows)})
+
+
+def best_time(func: Callable, df: pd.DataFrame, n_repeats: int) -> float:
+    """Return the best of n_repeats run times of func(df) in milliseconds."""
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        func(df)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1e3
+
+
+def run(n_rows: int, n_repeats: int = 3, builtin_sum: bool = True) -> Dict[str, List[float]]:
+    """Return run times of metrics, and of the previous implementation, in milliseconds."""
+    df = make_table(n_rows)
+    times = {}
+    for name, metric in METRICS.items():
+        times[name] = [best_time(metric, df, n_repeats)]
+        if builtin_sum:
+            assert BUILTIN_SUM[name](df) == metric(df)["count"]
+            times[name].append(best_time(BUILTIN_SUM[name], df, 1))
+    return times
+
+
+def main(
+        n_rows_grid: List[int] = (1_000_000, 10_000_000, 50_000_000), n_repeats: int = 3, builtin_sum: bool = True
+) -> None:
+    """Print run times table"""
+    print("Run time, ms. pandas engine, and builtin sum() of the previous implementation")
+    print(f"{'metric':>18} {'rows':>10} {'numpy':>10} {'sum()':>10} {'speedup':>8}")
+    for n_rows in n_rows_grid:
+        for name, times in run(n_rows, n_repeats, builtin_sum).items():
+            if builtin_sum:
+                print(f"{name:>18} {n_rows:>10} {times[0]:>10.1f} {times[1]:>10.1f} {times[1] / times[0]:>8.0f}")
+            else:
+                print(f"{name:>18} {n_rows:>10} {times[0]:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
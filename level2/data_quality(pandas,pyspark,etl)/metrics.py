@@ -1,13 +1,19 @@
 """Metrics."""
 
-from typing import Any, Dict, Union, List
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from dataclasses import dataclass
+from functools import reduce
 import datetime
 
+import numpy as np
 import pandas as pd
 import pyspark.sql as ps
 
 
+# Column values, NumPy array for numeric columns
+ArrayType = Union[np.ndarray, pd.Series]
+
+
 @dataclass
 class Metric:
     """Base class for Metric"""
@@ -27,11 +33,82 @@ class Metric:
         raise NotImplementedError(msg)
 
     def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
-        return {}
+        condition = self._condition_pandas()
+        if condition is None:
+            return {}
+        columns, function = condition
+        return _count_result({"total": len(df), "count": _count_true(function(*_column_values(df, columns)))})
+
+    def _condition_pandas(self) -> Optional[Tuple[List[str], Callable[..., ArrayType]]]:
+        """Columns and row condition the metric counts, None if it isn't a count of rows.
+
+        The condition gets values of the columns (of all rows or of a block of
+        them) and returns a boolean mask. Report counts conditions of all
+        checks of a table in a single pass over blocks of rows.
+        """
+        return None
 
     def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+        aggregations = self._aggregations_pyspark(df)
+        if not aggregations:
+            return {}
+        row = df.agg(*[column.alias(name) for name, column in aggregations.items()]).collect()[0]
+        return self._from_aggregations(row.asDict())
+
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
+        """Named aggregate expressions the metric is computed from, empty if it needs its own jobs.
+
+        Report computes aggregations of all checks of a table in a single
+        df.agg(), i.e. with one scan of the table.
+        """
         return {}
 
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Metric from values of its aggregations."""
+        return {}
+
+
+def _numpy_values(series: pd.Series) -> ArrayType:
+    """Values of a numeric column as a NumPy array view, other columns as they are."""
+    if isinstance(series.dtype, np.dtype) and series.dtype.kind in "biuf":
+        return series.to_numpy(copy=False)
+    return series
+
+
+def _column_values(df: pd.DataFrame, columns: List[str]) -> List[ArrayType]:
+    return [_numpy_values(df[column]) for column in columns]
+
+
+def _count_true(mask: ArrayType) -> int:
+    """Number of true values of a boolean mask, missing values are not counted."""
+    if isinstance(mask, np.ndarray):
+        return int(np.count_nonzero(mask))
+    return int(mask.sum())
+
+
+def _count_aggregations(condition: ps.Column) -> Dict[str, ps.Column]:
+    """Number of rows and of rows where condition is true."""
+    from pyspark.sql.functions import count, lit, when
+
+    return {"total": count(lit(1)), "count": count(when(condition, True))}
+
+
+def _count_result(values: Dict[str, Any]) -> Dict[str, Any]:
+    n, k = values["total"], values["count"]
+    return {"total": n, "count": k, "delta": k / n}
+
+
+def _not_nan(df: ps.DataFrame, columns: List[str]) -> ps.Column:
+    """Condition that floating point columns are not NaN, which dropna() also drops."""
+    from pyspark.sql.functions import col, isnan, lit
+    from pyspark.sql.types import DoubleType, FloatType
+
+    condition = lit(True)
+    for column in columns:
+        if isinstance(df.schema[column].dataType, (DoubleType, FloatType)):
+            condition = condition & ~isnan(col(column))
+    return condition
+
 
 @dataclass
 class CountTotal(Metric):
@@ -40,8 +117,13 @@ class CountTotal(Metric):
     def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
         return {"total": len(df)}
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
-        return {"total": df.count()}
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
+        from pyspark.sql.functions import count, lit
+
+        return {"total": count(lit(1))}
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return {"total": values["total"]}
 
 
 @dataclass
@@ -50,17 +132,16 @@ class CountZeros(Metric):
 
     column: str
 
-    def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
-        n = len(df)
-        k = sum(df[self.column] == 0)
-        return {"total": n, "count": k, "delta": k / n}
+    def _condition_pandas(self) -> Optional[Tuple[List[str], Callable[..., ArrayType]]]:
+        return [self.column], lambda values: values == 0
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
         from pyspark.sql.functions import col
 
-        n = df.count()
-        k = df.filter(col(self.column) == 0).count()
-        return {"total": n, "count": k, "delta": k / n}
+        return _count_aggregations(col(self.column) == 0)
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return _count_result(values)
 
 
 @dataclass
@@ -70,15 +151,33 @@ class CountNull(Metric):
     columns: List[str]
     aggregation: str = "any"  # either "all", or "any"
 
-    def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
-        n = len(df)
-        k = df[self.columns].isna().agg(self.aggregation, axis=1).sum()
-        return {"total": n, "count": k, "delta": k / n}
+    def _condition_pandas(self) -> Optional[Tuple[List[str], Callable[..., ArrayType]]]:
+        if self.aggregation not in ("any", "all"):
+            raise ValueError(f"aggregation ('{self.aggregation}') should be 'any' or 'all'")
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
-        n = df.count()
-        k = n - df.dropna(how=self.aggregation, subset=self.columns).count()
-        return {"total": n, "count": k, "delta": k / n}
+        def empty(*columns: ArrayType) -> np.ndarray:
+            masks = [np.asarray(pd.isna(values)) for values in columns]
+            if self.aggregation == "any":
+                return reduce(np.logical_or, masks)
+            return reduce(np.logical_and, masks)
+
+        return list(self.columns), empty
+
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
+        from functools import reduce
+        from pyspark.sql.functions import col
+
+        if self.aggregation not in ("any", "all"):
+            raise ValueError(f"aggregation ('{self.aggregation}') should be 'any' or 'all'")
+
+        # Empty values as dropna() finds them, null or NaN
+        empty = [col(column).isNull() | ~_not_nan(df, [column]) for column in self.columns]
+        if self.aggregation == "any":
+            return _count_aggregations(reduce(lambda a, b: a | b, empty))
+        return _count_aggregations(reduce(lambda a, b: a & b, empty))
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return _count_result(values)
 
 
 @dataclass
@@ -105,17 +204,16 @@ class CountValue(Metric):
     column: str
     value: Union[str, int, float]
 
-    def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
-        n = len(df)
-        k = sum(df[self.column] == self.value)
-        return {"total": n, "count": k, "delta": k / n}
+    def _condition_pandas(self) -> Optional[Tuple[List[str], Callable[..., ArrayType]]]:
+        return [self.column], lambda values: values == self.value
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
         from pyspark.sql.functions import col
 
-        n = df.count()
-        k = df.filter(col(self.column) == self.value).count()
-        return {"total": n, "count": k, "delta": k / n}
+        return _count_aggregations(col(self.column) == self.value)
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return _count_result(values)
 
 
 @dataclass
@@ -126,23 +224,20 @@ class CountBelowValue(Metric):
     value: float
     strict: bool = False
 
-    def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
-        n = len(df)
+    def _condition_pandas(self) -> Optional[Tuple[List[str], Callable[..., ArrayType]]]:
         if self.strict:
-            k = sum(df[self.column] < self.value)
-        else:
-            k = sum(df[self.column] <= self.value)
-        return {"total": n, "count": k, "delta": k / n}
+            return [self.column], lambda values: values < self.value
+        return [self.column], lambda values: values <= self.value
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
         from pyspark.sql.functions import col
 
-        n = df.count()
         if self.strict:
-            k = df.filter(col(self.column) < self.value).count()
-        else:
-            k = df.filter(col(self.column) <= self.value).count()
-        return {"total": n, "count": k, "delta": k / n}
+            return _count_aggregations(col(self.column) < self.value)
+        return _count_aggregations(col(self.column) <= self.value)
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return _count_result(values)
 
 
 @dataclass
@@ -153,24 +248,22 @@ class CountBelowColumn(Metric):
     column_y: str
     strict: bool = False
 
-    def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
-        n = len(df)
+    def _condition_pandas(self) -> Optional[Tuple[List[str], Callable[..., ArrayType]]]:
         if self.strict:
-            k = sum(df[self.column_x] < df[self.column_y])
-        else:
-            k = sum(df[self.column_x] <= df[self.column_y])
-        return {"total": n, "count": k, "delta": k / n}
+            return [self.column_x, self.column_y], lambda x, y: x < y
+        return [self.column_x, self.column_y], lambda x, y: x <= y
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
         from pyspark.sql.functions import col
 
-        n = df.count()
-        df_dropna = df.dropna(how='any', subset=[self.column_x, self.column_y])
+        # Comparisons with nulls are not true, NaN rows are skipped explicitly
+        not_nan = _not_nan(df, [self.column_x, self.column_y])
         if self.strict:
-            k = df_dropna.filter(col(self.column_x) < col(self.column_y)).count()
-        else:
-            k = df_dropna.filter(col(self.column_x) <= col(self.column_y)).count()
-        return {"total": n, "count": k, "delta": k / n}
+            return _count_aggregations(not_nan & (col(self.column_x) < col(self.column_y)))
+        return _count_aggregations(not_nan & (col(self.column_x) <= col(self.column_y)))
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return _count_result(values)
 
 
 @dataclass
@@ -182,24 +275,28 @@ class CountRatioBelow(Metric):
     column_z: str
     strict: bool = False
 
-    def _call_pandas(self, df: pd.DataFrame) -> Dict[str, Any]:
-        n = len(df)
-        if self.strict:
-            k = sum(df[self.column_x] / df[self.column_y] < df[self.column_z])
-        else:
-            k = sum(df[self.column_x] / df[self.column_y] <= df[self.column_z])
-        return {"total": n, "count": k, "delta": k / n}
+    def _condition_pandas(self) -> Optional[Tuple[List[str], Callable[..., ArrayType]]]:
+        def below(x: ArrayType, y: ArrayType, z: ArrayType) -> ArrayType:
+            # Division by zero gives inf or NaN, as in pandas
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = x / y
+            if self.strict:
+                return ratio < z
+            return ratio <= z
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+        return [self.column_x, self.column_y, self.column_z], below
+
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
         from pyspark.sql.functions import col
 
-        n = df.count()
-        df_dpopna = df.dropna(how='any', subset=[self.column_x, self.column_y, self.column_z])
+        not_nan = _not_nan(df, [self.column_x, self.column_y, self.column_z])
+        ratio = col(self.column_x) / col(self.column_y)
         if self.strict:
-            k = df_dpopna.filter(col(self.column_x) / col(self.column_y) < col(self.column_z)).count()
-        else:
-            k = df_dpopna.filter(col(self.column_x) / col(self.column_y) <= col(self.column_z)).count()
-        return {"total": n, "count": k, "delta": k / n}
+            return _count_aggregations(not_nan & (ratio < col(self.column_z)))
+        return _count_aggregations(not_nan & (ratio <= col(self.column_z)))
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return _count_result(values)
 
 
 @dataclass
@@ -213,11 +310,16 @@ class CountCB(Metric):
         lcb, ucb = df[self.column].quantile(((1 - self.conf) / 2, (1 + self.conf) / 2))
         return {"lcb": lcb, "ucb": ucb}
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
+        from pyspark.sql.functions import col, when
         from pyspark.sql.functions import percentile_approx as pa
-        lcb, ucb = df.dropna(how='any', subset=[self.column]).select(
-            pa(self.column, ((1 - self.conf) / 2, (1 + self.conf) / 2))
-        ).collect()[0][0]
+
+        # Aggregates skip nulls, NaN are replaced by nulls
+        values = when(_not_nan(df, [self.column]), col(self.column))
+        return {"bounds": pa(values, [(1 - self.conf) / 2, (1 + self.conf) / 2])}
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        lcb, ucb = values["bounds"]
         return {"lcb": lcb, "ucb": ucb}
 
 
@@ -234,9 +336,13 @@ class CountLag(Metric):
         lag = (a - pd.to_datetime(b)).days
         return {"today": a.strftime(self.fmt), "last_day": b, "lag": lag}
 
-    def _call_pyspark(self, df: ps.DataFrame) -> Dict[str, Any]:
+    def _aggregations_pyspark(self, df: ps.DataFrame) -> Dict[str, ps.Column]:
         from pyspark.sql.functions import max as ps_max
+
+        return {"last_day": ps_max(self.column)}
+
+    def _from_aggregations(self, values: Dict[str, Any]) -> Dict[str, Any]:
         a = datetime.datetime.today()
-        b = df.select(ps_max(self.column)).collect()[0][0]
+        b = values["last_day"]
         lag = (a - datetime.datetime.strptime(b, self.fmt)).days
         return {"today": a.strftime(self.fmt), "last_day": b, "lag": lag}
@@ -1,8 +1,10 @@
 """DQ Report."""
 
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
+from collections import defaultdict
 from dataclasses import dataclass, field
-from user_input.metrics import Metric
+import hashlib
+from user_input.metrics import ArrayType, Metric, _count_true, _numpy_values
 
 import pandas as pd
 import pyspark.sql as ps
@@ -10,6 +12,17 @@ import pyspark.sql as ps
 
 LimitType = Dict[str, Tuple[float, float]]
 CheckType = Tuple[str, Metric, LimitType]
+ValueType = Union[Dict, Exception]
+
+# Rows in a block of the single pass over a pandas table
+BLOCK_ROWS = 1 << 16
+
+
+def _block(values: ArrayType, start: int, stop: int) -> ArrayType:
+    """Rows start:stop of column values, a view of NumPy arrays"""
+    if isinstance(values, pd.Series):
+        return values.iloc[start:stop]
+    return values[start:stop]
 
 
 @dataclass
@@ -19,37 +32,234 @@ class Report:
     checklist: List[CheckType]
     engine: str = "pandas"
     memory_: Dict = field(default_factory=dict)
+    # Number of reports kept in memory_, least recently used ones are dropped
+    memory_size: int = 128
+
+    def fit(
+            self,
+            tables: Dict[str, Union[pd.DataFrame, ps.DataFrame]],
+            fingerprints: Optional[Dict[str, str]] = None,
+    ) -> Dict:
+        """Calculate DQ metrics and build report.
 
-    def fit(self, tables: Dict[str, Union[pd.DataFrame, ps.DataFrame]]) -> Dict:
-        """Calculate DQ metrics and build report."""
+        fingerprints are ids of tables content, e.g. snapshot ids of Delta or
+        Iceberg tables. They identify tables for caching instead of hashing
+        their content.
+        """
 
         if self.engine == "pandas":
-            return self._fit_pandas(tables)
+            return self._fit_pandas(tables, fingerprints)
 
         if self.engine == "pyspark":
-            return self._fit_pyspark(tables)
+            return self._fit_pyspark(tables, fingerprints)
 
         raise NotImplementedError("Only pandas and pyspark APIs currently supported!")
 
     @staticmethod
-    def _hash_pandas_dict(tables: Dict[str, pd.DataFrame]) -> str:
-        """Returns hash of dictionary with pd.DataFrames as values"""
-        return str({key: tables[key] for key in sorted(tables.keys())})
+    def _hash_pandas_dict(tables: Dict[str, pd.DataFrame], fingerprints: Optional[Dict[str, str]] = None) -> str:
+        """Returns hash of dictionary with pd.DataFrames as values
+
+        Digest of names, columns, dtypes and pd.util.hash_pandas_object of
+        rows (with index) of the tables.
+        """
+        fingerprints = fingerprints or {}
+        digest = hashlib.blake2b(digest_size=16)
+
+        for key in sorted(tables.keys()):
+            df = tables[key]
+            if key in fingerprints:
+                digest.update(repr((key, fingerprints[key])).encode())
+                continue
+
+            digest.update(repr((key, list(df.columns), [str(dtype) for dtype in df.dtypes])).encode())
+            try:
+                rows = pd.util.hash_pandas_object(df, index=True)
+            except TypeError:
+                # Unhashable values, e.g. lists, are hashed by their string representation
+                rows = pd.util.hash_pandas_object(df.astype(str), index=True)
+            digest.update(rows.to_numpy())
+
+        return digest.hexdigest()
 
     @staticmethod
-    def _hash_pyspark_dict(tables: Dict[str, ps.DataFrame]) -> str:
-        """Returns hash of dictionary with ps.DataFrames as values"""
-        return str({key: tables[key].collect() for key in sorted(tables.keys())})
+    def _hash_pyspark_dict(tables: Dict[str, ps.DataFrame], fingerprints: Optional[Dict[str, str]] = None) -> str:
+        """Returns hash of dictionary with ps.DataFrames as values
+
+        Rows are hashed with xxhash64 by executors, only the number of rows
+        and two sums of row hashes (with different seeds) get to the driver,
+        with the schema. The digest doesn't depend on order of rows.
+        xxhash64 skips null values, so each column is preceded by its null
+        flag, otherwise rows (null, 1) and (1, null) would get the same hash.
+        """
+        from pyspark.sql.functions import count, isnull, lit, xxhash64
+        from pyspark.sql.functions import sum as ps_sum
+
+        fingerprints = fingerprints or {}
+        digest = hashlib.blake2b(digest_size=16)
+
+        for key in sorted(tables.keys()):
+            df = tables[key]
+            if key in fingerprints:
+                digest.update(repr((key, fingerprints[key])).encode())
+                continue
+
+            # Names may repeat and df[name] would be ambiguous, so columns are renamed by position;
+            # a literal first argument seeds the hash
+            positional = df.toDF(*[f"_{i}" for i in range(len(df.columns))])
+            columns = [positional[name] for name in positional.columns]
+            values = [value for column in columns for value in (isnull(column), column)]
+            row = positional.agg(
+                count(lit(1)),
+                ps_sum(xxhash64(lit(0), *values).cast("decimal(38,0)")),
+                ps_sum(xxhash64(lit(1), *values).cast("decimal(38,0)")),
+            ).collect()[0]
+            digest.update(repr((key, df.schema.simpleString(), tuple(row))).encode())
+
+        return digest.hexdigest()
+
+    def _recall(self, hash_tables: str) -> Optional[Dict]:
+        """Report of tables from memory_, it becomes the most recently used"""
+        report = self.memory_.pop(hash_tables, None)
+        if report is not None:
+            self.memory_[hash_tables] = report
+        return report
+
+    def _remember(self, hash_tables: str, report: Dict) -> None:
+        """Save report of tables to memory_, dropping the least recently used ones above memory_size"""
+        self.memory_[hash_tables] = report
+        while len(self.memory_) > self.memory_size:
+            del self.memory_[next(iter(self.memory_))]
+
+    @staticmethod
+    def _call(metric: Metric, df: Union[pd.DataFrame, ps.DataFrame]) -> ValueType:
+        """Metric value, or exception raised by the metric"""
+        try:
+            return metric(df)
+        except Exception as err:
+            return err
+
+    def _compute_pandas(self, df: pd.DataFrame, metrics: Dict[str, Metric]) -> Dict[str, ValueType]:
+        """Metrics of a table with a single pass over blocks of rows for all their count conditions"""
+        values = {}
+        # Columns and condition of each count metric, values of used columns
+        conditions = {}
+        columns = {}
+
+        for key, metric in metrics.items():
+            try:
+                condition = metric._condition_pandas()
+                if condition is not None:
+                    for name in condition[0]:
+                        if name not in columns:
+                            columns[name] = _numpy_values(df[name])
+            except Exception:
+                # e.g. missing column, the metric computed on its own gets its error
+                values[key] = self._call(metric, df)
+                continue
+            if condition is None:
+                values[key] = self._call(metric, df)
+                continue
+            conditions[key] = condition
+
+        n = len(df)
+        counts = dict.fromkeys(conditions, 0)
+        for start in range(0, n, BLOCK_ROWS):
+            block = {name: _block(column, start, start + BLOCK_ROWS) for name, column in columns.items()}
+            for key in list(counts):
+                names, condition = conditions[key]
+                try:
+                    counts[key] += _count_true(condition(*[block[name] for name in names]))
+                except Exception:
+                    # e.g. comparison of incompatible types, the metric is computed on its own to get its error
+                    del counts[key]
+                    values[key] = self._call(metrics[key], df)
+
+        for key, k in counts.items():
+            try:
+                values[key] = metrics[key]._from_aggregations({"total": n, "count": k})
+            except Exception as err:
+                values[key] = err
+
+        return values
+
+    def _compute_pyspark(self, df: ps.DataFrame, metrics: Dict[str, Metric]) -> Dict[str, ValueType]:
+        """Metrics of a table with a single scan for all their aggregations"""
+        values = {}
+        # Aggregate expressions of all metrics: str(expression) -> (alias, expression)
+        expressions = {}
+        # Aliases of aggregations of each metric
+        aliases = {}
+
+        for key, metric in metrics.items():
+            try:
+                aggregations = metric._aggregations_pyspark(df)
+            except Exception as err:
+                values[key] = err
+                continue
+            if not aggregations:
+                values[key] = self._call(metric, df)
+                continue
+            aliases[key] = {
+                name: expressions.setdefault(str(column), (f"_{len(expressions)}", column))[0]
+                for name, column in aggregations.items()
+            }
+
+        if not aliases:
+            return values
+
+        try:
+            row = df.agg(*[column.alias(alias) for alias, column in expressions.values()]).collect()[0]
+        except Exception:
+            # A bad expression (e.g. missing column) fails the whole job, metrics are computed one by one
+            for key in aliases:
+                values[key] = self._call(metrics[key], df)
+            return values
+
+        for key, names in aliases.items():
+            try:
+                values[key] = metrics[key]._from_aggregations({name: row[alias] for name, alias in names.items()})
+            except Exception as err:
+                values[key] = err
+
+        return values
+
+    def _compute_metrics(self, tables: Dict[str, Union[pd.DataFrame, ps.DataFrame]]) -> List[ValueType]:
+        """Values of metrics of the checklist, exceptions for failed ones.
+
+        Checks are grouped by table and equal metrics of a table are computed
+        once. Aggregations of pyspark metrics of a table are compiled into a
+        single df.agg(), so the table is scanned once however many checks it
+        has; conditions of pandas count metrics are counted in a single pass
+        over blocks of BLOCK_ROWS rows, while they are in CPU cache.
+        """
+        checks = defaultdict(list)
+        for i, (table_name, metric, _) in enumerate(self.checklist):
+            checks[table_name].append(i)
+
+        results = [None] * len(self.checklist)
+        for table_name, indices in checks.items():
+            metrics = {repr(self.checklist[i][1]): self.checklist[i][1] for i in indices}
+
+            if table_name not in tables:
+                err = KeyError(table_name)
+                values = {key: err for key in metrics}
+            elif isinstance(tables[table_name], ps.DataFrame):
+                values = self._compute_pyspark(tables[table_name], metrics)
+            else:
+                values = self._compute_pandas(tables[table_name], metrics)
+
+            for i in indices:
+                results[i] = values[repr(self.checklist[i][1])]
+
+        return results
 
     def _build_report(self, tables: Dict[str, Union[pd.DataFrame, ps.DataFrame]], report: Dict) -> None:
         """Calculate DQ metrics and build report"""
         data = []
 
-        for (table_name, metric, limits) in self.checklist:
-            try:
-                value = metric(tables[table_name])
-            except Exception as err:
-                error = repr(err)
+        for (table_name, metric, limits), value in zip(self.checklist, self._compute_metrics(tables)):
+            if isinstance(value, Exception):
+                error = repr(value)
                 value = {}
                 status = "E"
             else:
@@ -74,37 +284,39 @@ class Report:
             report[key] = sum(report["result"]["status"] == value)
             report[key+"_pct"] = round(100 * report[key] / report["total"], 2)
 
-    def _fit_pandas(self, tables: Dict[str, pd.DataFrame]) -> Dict:
+    def _fit_pandas(self, tables: Dict[str, pd.DataFrame], fingerprints: Optional[Dict[str, str]] = None) -> Dict:
         """Calculate DQ metrics and build report.  Engine: Pandas"""
 
         self.report_ = {}
         report = self.report_
 
-        hash_tables = self._hash_pandas_dict(tables)
+        hash_tables = self._hash_pandas_dict(tables, fingerprints)
 
-        if hash_tables not in self.memory_:
+        cached = self._recall(hash_tables)
+        if cached is None:
             self._build_report(tables, report)
-            self.memory_[hash_tables] = report
+            self._remember(hash_tables, report)
         else:
-            self.report_ = self.memory_[hash_tables]
+            self.report_ = cached
 
-        return report
+        return self.report_
 
-    def _fit_pyspark(self, tables: Dict[str, ps.DataFrame]) -> Dict:
+    def _fit_pyspark(self, tables: Dict[str, ps.DataFrame], fingerprints: Optional[Dict[str, str]] = None) -> Dict:
         """Calculate DQ metrics and build report.  Engine: PySpark"""
 
         self.report_ = {}
         report = self.report_
 
-        hash_tables = self._hash_pyspark_dict(tables)
+        hash_tables = self._hash_pyspark_dict(tables, fingerprints)
 
-        if hash_tables not in self.memory_:
+        cached = self._recall(hash_tables)
+        if cached is None:
             self._build_report(tables, report)
-            self.memory_[hash_tables] = report
+            self._remember(hash_tables, report)
         else:
-            self.report_ = self.memory_[hash_tables]
+            self.report_ = cached
 
-        return report
+        return self.report_
 
     def to_str(self) -> str:
         """Convert report to string format."""
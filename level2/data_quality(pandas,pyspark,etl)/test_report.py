@@ -0,0 +1,158 @@
+"""Tests of Report caching: fingerprints of tables and memory_ eviction.
+
+The pyspark path runs on a stub of pyspark.sql.functions which, like Spark,
+evaluates column expressions row by row and skips null inputs of xxhash64.
+"""
+import hashlib
+import importlib
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+class Expression:
+    """Column expression of the stub, evaluated on a row tuple."""
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, row):
+        return self.function(row)
+
+    def cast(self, data_type):
+        return self
+
+
+class Aggregation:
+    """Aggregate expression of the stub, evaluated on a list of rows."""
+
+    def __init__(self, function):
+        self.function = function
+
+
+class Collected:
+    def __init__(self, row):
+        self.row = row
+
+    def collect(self):
+        return [self.row]
+
+
+class DataFrame:
+    """ps.DataFrame stub: rows of a schema, only what _hash_pyspark_dict uses."""
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.schema = types.SimpleNamespace(simpleString=lambda: f"struct<{','.join(columns)}>")
+
+    def __getitem__(self, name):
+        # Like Spark, a column is looked up by name, repeated names are ambiguous
+        if self.columns.count(name) != 1:
+            raise ValueError(f"Ambiguous or missing column {name}")
+        i = self.columns.index(name)
+        return Expression(lambda row: row[i])
+
+    def toDF(self, *columns):
+        return DataFrame(list(columns), self.rows)
+
+    def agg(self, *aggregations):
+        return Collected(tuple(aggregation.function(self.rows) for aggregation in aggregations))
+
+
+def xxhash64(*expressions):
+    def function(row):
+        digest = 0
+        for expression in expressions:
+            value = expression(row)
+            # Spark keeps the running hash on null inputs
+            if value is not None:
+                data = hashlib.blake2b(repr((digest, value)).encode(), digest_size=8).digest()
+                digest = int.from_bytes(data, "little", signed=True)
+        return digest
+
+    return Expression(function)
+
+
+FUNCTIONS = {
+    "count": lambda expression: Aggregation(lambda rows: sum(expression(row) is not None for row in rows)),
+    "isnull": lambda expression: Expression(lambda row: expression(row) is None),
+    "lit": lambda value: Expression(lambda row: value),
+    "sum": lambda expression: Aggregation(lambda rows: sum(expression(row) for row in rows)),
+    "xxhash64": xxhash64,
+}
+
+
+@pytest.fixture
+def report(monkeypatch):
+    """report module with pyspark.sql.functions stubbed"""
+    functions = types.ModuleType("pyspark.sql.functions")
+    functions.__dict__.update(FUNCTIONS)
+    if importlib.util.find_spec("pyspark") is None:
+        sql = types.ModuleType("pyspark.sql")
+        sql.DataFrame, sql.Column = DataFrame, Expression
+        monkeypatch.setitem(sys.modules, "pyspark", types.ModuleType("pyspark"))
+        monkeypatch.setitem(sys.modules, "pyspark.sql", sql)
+    monkeypatch.setitem(sys.modules, "pyspark.sql.functions", functions)
+    monkeypatch.delitem(sys.modules, "metrics", raising=False)
+    monkeypatch.delitem(sys.modules, "report", raising=False)
+    if importlib.util.find_spec("user_input") is None:
+        monkeypatch.setitem(sys.modules, "user_input", types.ModuleType("user_input"))
+        monkeypatch.setitem(sys.modules, "user_input.metrics", importlib.import_module("metrics"))
+    return importlib.import_module("report")
+
+
+def test_pyspark_hash_null_positions(report):
+    hash_tables = report.Report._hash_pyspark_dict
+    left = DataFrame(["x", "y"], [(None, 1), (2, 3)])
+    right = DataFrame(["x", "y"], [(1, None), (2, 3)])
+
+    assert hash_tables({"t": left}) != hash_tables({"t": right})
+
+
+def test_pyspark_hash_content(report):
+    hash_tables = report.Report._hash_pyspark_dict
+    df = DataFrame(["x", "y"], [(None, 1), (2, 3), (4, None)])
+
+    assert hash_tables({"t": df}) == hash_tables({"t": DataFrame(["x", "y"], df.rows[::-1])})
+    assert hash_tables({"t": df}) != hash_tables({"t": DataFrame(["x", "y"], [(None, 1), (2, 3), (5, None)])})
+    assert hash_tables({"t": df}) != hash_tables({"u": df})
+    assert hash_tables({"t": df}, {"t": "v1"}) == hash_tables({"t": DataFrame(["x", "y"], [])}, {"t": "v1"})
+
+
+def test_pyspark_hash_repeated_names(report):
+    hash_tables = report.Report._hash_pyspark_dict
+    df = DataFrame(["x", "x"], [(1, 2), (3, 4)])
+
+    assert hash_tables({"t": df}) != hash_tables({"t": DataFrame(["x", "x"], [(2, 1), (3, 4)])})
+
+
+def test_pandas_hash_middle_row(report):
+    hash_tables = report.Report._hash_pandas_dict
+    left = pd.DataFrame({"x": np.arange(10_000), "y": np.zeros(10_000)})
+    right = left.copy()
+    right.loc[5_000, "y"] = 1
+
+    # Printed frames are truncated, the differing row isn't shown
+    assert str(left) == str(right)
+    assert hash_tables({"t": left}) != hash_tables({"t": right})
+    assert hash_tables({"t": left}) == hash_tables({"t": left.copy()})
+
+
+def test_memory_evicts_least_recently_used(report):
+    metrics = importlib.import_module("metrics")
+    checks = report.Report([("t", metrics.CountZeros("x"), {})], memory_size=2)
+    tables = [{"t": pd.DataFrame({"x": [0] * i + [1]})} for i in range(3)]
+
+    first = checks.fit(tables[0])
+    checks.fit(tables[1])
+    assert checks.fit(tables[0]) is first
+    checks.fit(tables[2])
+
+    assert len(checks.memory_) == 2
+    # tables[1] was used least recently, it is computed again
+    assert checks.fit(tables[0]) is first
+    assert report.Report._hash_pandas_dict(tables[1]) not in checks.memory_
@@ -1,74 +1,338 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 import os
+import threading
+import time
 import numpy as np
 import uvicorn
-from fastapi import FastAPI
-from fastapi_utils.tasks import repeat_every
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from scipy.special import logsumexp
 from sklearn.neighbors import KernelDensity
 
+from embedding_store import EmbeddingStore, EmbeddingStoreLoader, UnknownItemsError
+from ivf_index import IVFIndex
+from result_cache import ResultCache
+
 
 DIVERSITY_THRESHOLD = 10
+# KDE engine used by the endpoints: "numpy" (closed form), "sklearn" or "ivf" (approximate)
+KDE_ENGINE = "numpy"
+# Number of IVF lists scanned per item, trades recall for latency
+IVF_NPROBE = 8
+# Seconds between checks of embeddings file
+RELOAD_INTERVAL = 10
 
 app = FastAPI()
-embeddings = {}
+embeddings = EmbeddingStoreLoader(os.path.join(os.path.dirname(__file__), "embeddings.npy"))
+# ANN index over the current store, built on reload if KDE_ENGINE is "ivf"
+ann_index: Optional[IVFIndex] = None
+# Results of repeated groups, keys include store version
+results = ResultCache(max_entries=10000, max_bytes=64 << 20, ttl=600)
+# Reload statistics, served on /metrics/
+reload_stats = {
+    "reloads": 0,
+    "errors": 0,
+    "last_error": "",
+    "last_check": None,
+    "last_reload": None,
+    "last_reload_duration": None,
+}
+stop_reload = threading.Event()
 
 
-@app.on_event("startup")
-@repeat_every(seconds=10)
 def load_embeddings() -> dict:
     """Load embeddings from file."""
+    global ann_index
+
+    # New store is swapped in only if the file changed
+    start = time.perf_counter()
+    if embeddings.refresh():
+        # Results of the previous catalogue can't be hit anymore
+        results.clear()
+        if KDE_ENGINE == "ivf":
+            store = embeddings.store
+            ann_index = IVFIndex.build(store.matrix, version=store.version)
 
-    # Load new embeddings each 10 seconds
-    path = os.path.join(os.path.dirname(__file__), "embeddings.npy")
-    embeddings_raw = np.load(path, allow_pickle=True).item()
-    for item_id, embedding in embeddings_raw.items():
-        embeddings[item_id] = embedding
+        reload_stats["reloads"] += 1
+        reload_stats["last_reload"] = time.time()
+        reload_stats["last_reload_duration"] = time.perf_counter() - start
+
+    reload_stats["last_check"] = time.time()
 
     return {}
 
 
+def reload_worker() -> None:
+    """Check embeddings file each RELOAD_INTERVAL seconds in a background thread."""
+    while not stop_reload.wait(RELOAD_INTERVAL):
+        try:
+            load_embeddings()
+        except Exception as err:
+            # Keep serving the previous store
+            reload_stats["errors"] += 1
+            reload_stats["last_error"] = repr(err)
+
+
+@app.on_event("startup")
+def startup_event():
+    # First load blocks startup, so the service never serves an empty catalogue
+    load_embeddings()
+    stop_reload.clear()
+    threading.Thread(target=reload_worker, name="embeddings-reload", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    stop_reload.set()
+
+
+def parse_item_ids(item_ids: str) -> np.ndarray:
+    """Parse comma-separated item ids into int64 array."""
+    try:
+        return np.array(item_ids.split(","), dtype=np.int64)
+    except (ValueError, OverflowError):
+        raise HTTPException(
+            status_code=422,
+            detail={"error": "invalid item ids", "item_ids": item_ids},
+        )
+
+
+def lookup(item_ids: np.ndarray) -> Tuple[EmbeddingStore, np.ndarray]:
+    """Resolve item ids to rows of current store."""
+    store = embeddings.store
+    try:
+        return store, store.rows(item_ids)
+    except UnknownItemsError as err:
+        raise HTTPException(
+            status_code=404,
+            detail={"error": "unknown item ids", "item_ids": err.item_ids.tolist()},
+        )
+
+
+def select_engine(store: EmbeddingStore) -> Tuple[str, Optional[IVFIndex]]:
+    """Return KDE engine and ANN index matching the store."""
+    index = ann_index
+    if KDE_ENGINE == "ivf" and (index is None or index.version != store.version):
+        # Index for the new store is not built yet, use exact KDE meanwhile
+        return "numpy", None
+    return KDE_ENGINE, index
+
+
+def cache_key(*params, item_ids: np.ndarray) -> tuple:
+    """Cache key of a group: request parameters and canonical (sorted) item ids."""
+    return params + (np.sort(item_ids).tobytes(),)
+
+
+@app.get("/cache/stats/")
+def cache_stats() -> dict:
+    """Return result cache counters"""
+    return results.stats()
+
+
+@app.get("/metrics/")
+def metrics() -> dict:
+    """Return embeddings reload metrics"""
+    store = embeddings.store
+    return {
+        **reload_stats,
+        "catalogue_size": len(store),
+        "catalogue_version": store.version,
+    }
+
+
 @app.get("/uniqueness/")
-def uniqueness(item_ids: str) -> dict:
+def uniqueness(item_ids: str, nprobe: int = IVF_NPROBE) -> dict:
     """Calculate uniqueness of each product"""
 
-    # Parse item IDs
-    item_ids = [int(item) for item in item_ids.split(",")]
-    item_embeddings = np.array([embeddings[item_id] for item_id in item_ids])
+    # Parse item IDs, sort them so any permutation of the group hits the cache
+    item_ids = parse_item_ids(item_ids)
+    order = np.argsort(item_ids, kind="stable")
+    store, rows = lookup(item_ids[order])
+    engine, index = select_engine(store)
 
     # Calculate uniqueness
-    uniqueness = kde_uniqueness(item_embeddings)
-    item_uniqueness = dict(zip(item_ids, uniqueness))
+    key = cache_key("uniqueness", store.version, engine, nprobe, item_ids=item_ids)
+    sorted_uniqueness = results.get(key)
+    if sorted_uniqueness is None:
+        sorted_uniqueness = kde_uniqueness(store.matrix[rows], engine, index, rows, nprobe)
+        results.put(key, sorted_uniqueness, sorted_uniqueness.nbytes + len(key[-1]))
+
+    uniqueness = np.empty_like(sorted_uniqueness)
+    uniqueness[order] = sorted_uniqueness
+    item_uniqueness = dict(zip(item_ids.tolist(), uniqueness.tolist()))
 
     return item_uniqueness
 
 
 @app.get("/diversity/")
-def diversity(item_ids: str, threshold: float = 10) -> dict:
+def diversity(item_ids: str, threshold: float = 10, nprobe: int = IVF_NPROBE) -> dict:
     """Calculate diversity of group of products"""
 
     # Parse item IDs
-    item_ids = [int(item) for item in item_ids.split(",")]
-    item_embeddings = np.array([embeddings[item_id] for item_id in item_ids])
+    item_ids = parse_item_ids(item_ids)
+    store, rows = lookup(item_ids)
+    engine, index = select_engine(store)
 
     # Default answer
     answer = {"diversity": 0.0, "reject": True}
 
     # Calculate diversity
-    reject, diversity = group_diversity(item_embeddings, threshold)
+    key = cache_key("diversity", store.version, engine, nprobe, threshold, item_ids=item_ids)
+    cached = results.get(key)
+    if cached is None:
+        cached = group_diversity(store.matrix[rows], threshold, engine, index, rows, nprobe)
+        results.put(key, cached, len(key[-1]) + 64)
+    reject, diversity = cached
     answer["reject"] = reject
     answer["diversity"] = diversity
 
     return answer
 
 
-def kde_uniqueness(embeddings: np.ndarray) -> np.ndarray:
+async def parse_groups(request: Request) -> Tuple[np.ndarray, np.ndarray]:
+    """Parse groups of item ids from request body.
+
+    Supported bodies:
+    - application/json: {"groups": [[item_id, ...], ...]}
+    - application/octet-stream: little-endian int64 array
+      [n_groups, len_1, ..., len_n, item ids of all groups]
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        item ids of all groups concatenated
+        group offsets, group i is item_ids[offsets[i]:offsets[i + 1]]
+
+    """
+    try:
+        if request.headers.get("content-type", "").startswith("application/octet-stream"):
+            body = np.frombuffer(await request.body(), dtype="<i8")
+            n_groups = int(body[0])
+            if not 0 < n_groups < len(body):
+                raise ValueError("invalid number of groups")
+            lengths = body[1:n_groups + 1]
+            item_ids = body[n_groups + 1:].astype(np.int64)
+        else:
+            groups = (await request.json())["groups"]
+            items = [item for group in groups for item in group]
+            # Floats would be silently truncated and bools taken for 0 and 1
+            if not all(type(item) is int for item in items):
+                raise ValueError("item ids must be integers")
+            lengths = np.array([len(group) for group in groups], dtype=np.int64)
+            item_ids = np.array(items, dtype=np.int64)
+    except (ValueError, TypeError, KeyError, IndexError, OverflowError):
+        raise HTTPException(status_code=422, detail={"error": "invalid groups body"})
+
+    if len(lengths) == 0 or lengths.min() <= 0 or lengths.sum() != len(item_ids):
+        raise HTTPException(status_code=422, detail={"error": "invalid groups body"})
+
+    return item_ids, np.concatenate(([0], np.cumsum(lengths)))
+
+
+def score_groups(item_ids: np.ndarray, offsets: np.ndarray, nprobe: int) -> np.ndarray:
+    """Uniqueness of items of all groups, with a single lookup for all of them."""
+    store, rows = lookup(item_ids)
+    engine, index = select_engine(store)
+    return batch_kde_uniqueness(store.matrix, rows, offsets, engine, index, nprobe)
+
+
+@app.post("/uniqueness/batch")
+async def uniqueness_batch(request: Request, nprobe: int = IVF_NPROBE) -> list:
+    """Calculate uniqueness of each product for many groups"""
+
+    item_ids, offsets = await parse_groups(request)
+    uniqueness = await run_in_threadpool(score_groups, item_ids, offsets, nprobe)
+
+    item_ids, uniqueness = item_ids.tolist(), uniqueness.tolist()
+    return [
+        dict(zip(item_ids[start:stop], uniqueness[start:stop]))
+        for start, stop in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+@app.post("/diversity/batch")
+async def diversity_batch(request: Request, threshold: float = 10, nprobe: int = IVF_NPROBE) -> dict:
+    """Calculate diversity of many groups of products"""
+
+    item_ids, offsets = await parse_groups(request)
+    uniqueness = await run_in_threadpool(score_groups, item_ids, offsets, nprobe)
+
+    # Group means of uniqueness
+    diversity = np.add.reduceat(uniqueness, offsets[:-1]) / np.diff(offsets)
+    reject = diversity >= threshold
+
+    return {"diversity": diversity.tolist(), "reject": reject.tolist()}
+
+
+def gaussian_log_density(
+        embeddings: np.ndarray, bandwidth: float = 1.0, block_size: int = 1024
+) -> np.ndarray:
+    """Gaussian KDE log-density of each item, evaluated on the group itself.
+
+    Closed form of sklearn's KernelDensity(kernel="gaussian").score_samples:
+    pairwise squared distances are computed blockwise as
+    ||a||^2 + ||b||^2 - 2ab and reduced with logsumexp, so peak memory is
+    block_size x n_items.
+
+    Parameters
+    ----------
+    embeddings: np.ndarray :
+        embeddings group
+    bandwidth: float :
+        kernel bandwidth (Default value = 1.0)
+    block_size: int :
+        number of rows of distance matrix computed at once (Default value = 1024)
+
+    Returns
+    -------
+    np.ndarray
+        log-density estimates
+
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    n_items, dim = embeddings.shape
+    sq_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+
+    log_density = np.empty(n_items)
+    for start in range(0, n_items, block_size):
+        # Distances are computed in place of the matrix product
+        sq_dist = embeddings[start:start + block_size] @ embeddings.T
+        sq_dist *= -2
+        sq_dist += sq_norms[None, :]
+        sq_dist += sq_norms[start:start + block_size, None]
+        np.maximum(sq_dist, 0, out=sq_dist)
+        sq_dist *= -0.5 / bandwidth**2
+        log_density[start:start + block_size] = logsumexp(sq_dist, axis=1)
+
+    # Normalize by number of items and gaussian kernel constant
+    log_density -= np.log(n_items) + 0.5 * dim * np.log(2 * np.pi) + dim * np.log(bandwidth)
+
+    return log_density
+
+
+def kde_uniqueness(
+        embeddings: np.ndarray,
+        engine: str = "sklearn",
+        index: Optional[IVFIndex] = None,
+        rows: Optional[np.ndarray] = None,
+        nprobe: int = IVF_NPROBE,
+) -> np.ndarray:
     """Estimate uniqueness of each item in item embeddings group. Based on KDE.
 
     Parameters
     ----------
     embeddings: np.ndarray :
         embeddings group
+    engine: str :
+        "sklearn" (KernelDensity), "numpy" (closed form)
+        or "ivf" (approximate, IVFIndex) (Default value = "sklearn")
+    index: Optional[IVFIndex] :
+        catalogue index for "ivf" engine (Default value = None)
+    rows: Optional[np.ndarray] :
+        catalogue rows of the group for "ivf" engine (Default value = None)
+    nprobe: int :
+        number of lists scanned per item for "ivf" engine (Default value = IVF_NPROBE)
 
     Returns
     -------
@@ -76,14 +340,30 @@ def kde_uniqueness(embeddings: np.ndarray) -> np.ndarray:
         uniqueness estimates
 
     """
-    # Fit a kernel density estimator to the item embedding space
-    kde = KernelDensity().fit(embeddings)
-    uniqueness = 1 / np.exp(kde.score_samples(embeddings))
+    if engine == "sklearn":
+        # Fit a kernel density estimator to the item embedding space
+        kde = KernelDensity().fit(embeddings)
+        log_density = kde.score_samples(embeddings)
+    elif engine == "numpy":
+        log_density = gaussian_log_density(embeddings)
+    elif engine == "ivf":
+        log_density = index.kernel_log_density(rows, nprobe, subset=rows)
+    else:
+        raise NotImplementedError("Only sklearn, numpy and ivf KDE engines currently supported!")
+
+    uniqueness = 1 / np.exp(log_density)
 
     return uniqueness
 
 
-def group_diversity(embeddings: np.ndarray, threshold: float) -> Tuple[bool, float]:
+def group_diversity(
+        embeddings: np.ndarray,
+        threshold: float,
+        engine: str = "sklearn",
+        index: Optional[IVFIndex] = None,
+        rows: Optional[np.ndarray] = None,
+        nprobe: int = IVF_NPROBE,
+) -> Tuple[bool, float]:
     """Calculate group diversity based on kde uniqueness.
 
     Parameters
@@ -92,6 +372,14 @@ def group_diversity(embeddings: np.ndarray, threshold: float) -> Tuple[bool, flo
         embeddings group
     threshold: float:
         threshold for group diversity
+    engine: str :
+        KDE engine, see kde_uniqueness (Default value = "sklearn")
+    index: Optional[IVFIndex] :
+        catalogue index for "ivf" engine (Default value = None)
+    rows: Optional[np.ndarray] :
+        catalogue rows of the group for "ivf" engine (Default value = None)
+    nprobe: int :
+        number of lists scanned per item for "ivf" engine (Default value = IVF_NPROBE)
 
     Returns
     -------
@@ -100,12 +388,126 @@ def group_diversity(embeddings: np.ndarray, threshold: float) -> Tuple[bool, flo
         group diversity
 
     """
-    diversity = kde_uniqueness(embeddings).mean()
+    diversity = kde_uniqueness(embeddings, engine, index, rows, nprobe).mean()
     reject = bool(diversity >= threshold)
 
     return reject, diversity
 
 
+def batch_gaussian_log_density(
+        embeddings: np.ndarray, offsets: np.ndarray, bandwidth: float = 1.0, max_elements: int = 1 << 22
+) -> np.ndarray:
+    """Gaussian KDE log-density of items of many groups, each group evaluated on itself.
+
+    Groups are sorted by size and processed in chunks padded to the same
+    size, so every chunk is a single batched matrix product. Padded items
+    are masked out of the kernel sums. Groups with more than max_elements
+    pairs don't fit in a chunk, they are computed by gaussian_log_density
+    in blocks of rows.
+
+    Parameters
+    ----------
+    embeddings: np.ndarray :
+        embeddings of all groups concatenated
+    offsets: np.ndarray :
+        group offsets, group i is embeddings[offsets[i]:offsets[i + 1]]
+    bandwidth: float :
+        kernel bandwidth (Default value = 1.0)
+    max_elements: int :
+        maximum size of padded distance tensor of a chunk (Default value = 4M)
+
+    Returns
+    -------
+    np.ndarray
+        log-density estimates of all items
+
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    dim = embeddings.shape[1]
+    lengths = np.diff(offsets)
+    order = np.argsort(lengths, kind="stable")
+    log_density = np.empty(len(embeddings))
+
+    # Groups are sorted by size, the ones after n_chunked are row-blocked
+    n_chunked = int(np.searchsorted(lengths[order] ** 2, max_elements, side="right"))
+
+    start = 0
+    while start < n_chunked:
+        # Groups are sorted by size, the last group of the chunk is the largest
+        size = lengths[order[start]]
+        stop = start + 1
+        while stop < n_chunked and (stop - start + 1) * lengths[order[stop]] ** 2 <= max_elements:
+            size = lengths[order[stop]]
+            stop += 1
+        groups = order[start:stop]
+        start = stop
+
+        positions = offsets[groups, None] + np.arange(size)[None, :]
+        mask = np.arange(size)[None, :] < lengths[groups, None]
+        positions = np.where(mask, positions, offsets[groups, None])
+
+        vectors = embeddings[positions]
+        sq_norms = np.einsum("gij,gij->gi", vectors, vectors)
+        sq_dist = sq_norms[:, :, None] + sq_norms[:, None, :] - 2 * vectors @ vectors.transpose(0, 2, 1)
+        np.maximum(sq_dist, 0, out=sq_dist)
+        sq_dist[~np.broadcast_to(mask[:, None, :], sq_dist.shape)] = np.inf
+
+        chunk_log_density = logsumexp(-0.5 * sq_dist / bandwidth**2, axis=2)
+        chunk_log_density -= np.log(lengths[groups, None])
+        log_density[positions[mask]] = chunk_log_density[mask]
+
+    # Normalize by gaussian kernel constant
+    log_density -= 0.5 * dim * np.log(2 * np.pi) + dim * np.log(bandwidth)
+
+    for group in order[n_chunked:]:
+        group_rows = slice(offsets[group], offsets[group + 1])
+        block_size = max(1, max_elements // lengths[group])
+        log_density[group_rows] = gaussian_log_density(embeddings[group_rows], bandwidth, block_size)
+
+    return log_density
+
+
+def batch_kde_uniqueness(
+        matrix: np.ndarray,
+        rows: np.ndarray,
+        offsets: np.ndarray,
+        engine: str = "sklearn",
+        index: Optional[IVFIndex] = None,
+        nprobe: int = IVF_NPROBE,
+) -> np.ndarray:
+    """Estimate uniqueness of each item in many item groups. Based on KDE.
+
+    Parameters
+    ----------
+    matrix: np.ndarray :
+        catalogue embeddings
+    rows: np.ndarray :
+        catalogue rows of all groups concatenated
+    offsets: np.ndarray :
+        group offsets, group i is rows[offsets[i]:offsets[i + 1]]
+    engine: str :
+        KDE engine, see kde_uniqueness (Default value = "sklearn")
+    index: Optional[IVFIndex] :
+        catalogue index for "ivf" engine (Default value = None)
+    nprobe: int :
+        number of lists scanned per item for "ivf" engine (Default value = IVF_NPROBE)
+
+    Returns
+    -------
+    np.ndarray
+        uniqueness estimates of all items
+
+    """
+    if engine == "numpy":
+        return 1 / np.exp(batch_gaussian_log_density(matrix[rows], offsets))
+
+    # Other engines have no batched form, score groups one by one
+    return np.concatenate([
+        kde_uniqueness(matrix[rows[start:stop]], engine, index, rows[start:stop], nprobe)
+        for start, stop in zip(offsets[:-1], offsets[1:])
+    ])
+
+
 def main() -> None:
     """Run application"""
     uvicorn.run("main:app", host="localhost", port=5000)
@@ -0,0 +1,232 @@
+"""Compact, memory-mapped embedding store for the uniqueness service."""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import hashlib
+import os
+import numpy as np
+
+
+class UnknownItemsError(KeyError):
+    """Some of requested item ids are not in the store."""
+
+    def __init__(self, item_ids: np.ndarray):
+        super().__init__(item_ids.tolist())
+        self.item_ids = item_ids
+
+
+@dataclass(frozen=True)
+class EmbeddingStore:
+    """Immutable snapshot of the embeddings catalogue.
+
+    Row ``i`` of ``matrix`` is the embedding of ``item_ids[i]``; ``item_ids``
+    is sorted, so ids are resolved with a binary search. A store is never
+    modified after creation: a reload builds a new store and swaps the
+    reference, so readers always see a consistent catalogue.
+
+    Parameters
+    ----------
+    item_ids: np.ndarray :
+        sorted int64 array of item ids
+    matrix: np.ndarray :
+        float32 matrix of embeddings (n_items, dim), may be memory-mapped
+    version: str :
+        checksum of the source file the store was built from
+
+    """
+
+    item_ids: np.ndarray
+    matrix: np.ndarray
+    version: str = ""
+
+    @classmethod
+    def empty(cls) -> "EmbeddingStore":
+        """Store without any items."""
+        return cls(np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32))
+
+    @classmethod
+    def from_dict(cls, embeddings: dict, version: str = "") -> "EmbeddingStore":
+        """Build store from dictionary of item_id: embedding."""
+        if not embeddings:
+            return cls(np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), version)
+
+        item_ids = np.fromiter(embeddings.keys(), dtype=np.int64, count=len(embeddings))
+        matrix = np.stack(list(embeddings.values())).astype(np.float32, copy=False)
+
+        order = np.argsort(item_ids, kind="stable")
+        return cls(item_ids[order], np.ascontiguousarray(matrix[order]), version)
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def __contains__(self, item_id: int) -> bool:
+        return bool(self._find(np.array([item_id], dtype=np.int64))[1][0])
+
+    def __getitem__(self, item_id: int) -> np.ndarray:
+        return self.matrix[self.rows(np.array([item_id], dtype=np.int64))[0]]
+
+    def _find(self, item_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return candidate row indices and mask of ids present in the store."""
+        if not len(self.item_ids):
+            return np.zeros(len(item_ids), dtype=np.intp), np.zeros(len(item_ids), dtype=bool)
+
+        rows = np.searchsorted(self.item_ids, item_ids)
+        np.minimum(rows, len(self.item_ids) - 1, out=rows)
+        return rows, self.item_ids[rows] == item_ids
+
+    def rows(self, item_ids: np.ndarray) -> np.ndarray:
+        """Resolve item ids to matrix row indices.
+
+        Parameters
+        ----------
+        item_ids: np.ndarray :
+            int64 array of item ids
+
+        Returns
+        -------
+        np.ndarray
+            row indices, one per item id
+
+        Raises
+        ------
+        UnknownItemsError
+            if some of the ids are not in the store
+
+        """
+        rows, found = self._find(item_ids)
+        if not found.all():
+            raise UnknownItemsError(np.unique(item_ids[~found]))
+        return rows
+
+    def take(self, item_ids: np.ndarray) -> np.ndarray:
+        """Gather embeddings of item ids with a single fancy-indexing call."""
+        return self.matrix[self.rows(item_ids)]
+
+
+def file_checksum(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return blake2b checksum of file content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class EmbeddingStoreLoader:
+    """Keep an EmbeddingStore in sync with the embeddings file.
+
+    The source file (a pickled dict of item_id: embedding) is converted once
+    per content checksum into two ``.npy`` files in ``cache_dir``, which are
+    then memory-mapped. Workers on the same host share the converted files
+    through the page cache, and a restart with an unchanged source skips the
+    conversion.
+
+    Parameters
+    ----------
+    path: str :
+        path to the embeddings file
+    cache_dir: Optional[str] :
+        directory for converted stores (Default value = "<path dir>/.embeddings_cache")
+
+    """
+
+    def __init__(self, path: str, cache_dir: Optional[str] = None):
+        self.path = path
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(path), ".embeddings_cache")
+        self.store = EmbeddingStore.empty()
+        self._file_stat: Optional[Tuple[int, int]] = None
+
+    def refresh(self) -> bool:
+        """Reload the store if the source file changed.
+
+        Returns
+        -------
+        bool
+            True if a new store was published
+
+        """
+        stat = os.stat(self.path)
+        file_stat = (stat.st_mtime_ns, stat.st_size)
+        if file_stat == self._file_stat:
+            return False
+
+        checksum = file_checksum(self.path)
+        if checksum == self.store.version:
+            # File was touched, but its content is the same
+            self._file_stat = file_stat
+            return False
+
+        store = self._load_cached(checksum)
+        if store is None:
+            store = self._convert(checksum)
+
+        # Single reference assignment: readers see either the old or the new store
+        self.store = store
+        self._file_stat = file_stat
+        self._prune_cache(checksum)
+
+        return True
+
+    def _cache_paths(self, checksum: str) -> Tuple[str, str]:
+        prefix = os.path.join(self.cache_dir, checksum)
+        return prefix + ".ids.npy", prefix + ".matrix.npy"
+
+    def _load_cached(self, checksum: str) -> Optional[EmbeddingStore]:
+        ids_path, matrix_path = self._cache_paths(checksum)
+        if not (os.path.exists(ids_path) and os.path.exists(matrix_path)):
+            return None
+
+        try:
+            item_ids = np.load(ids_path)
+            matrix = np.load(matrix_path, mmap_mode="r")
+        except FileNotFoundError:
+            # Pruned by another worker meanwhile, the store is converted again
+            return None
+        return EmbeddingStore(item_ids, matrix, checksum)
+
+    def _convert(self, checksum: str) -> EmbeddingStore:
+        embeddings_raw = np.load(self.path, allow_pickle=True).item()
+        store = EmbeddingStore.from_dict(embeddings_raw, checksum)
+        del embeddings_raw
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for path, array in zip(self._cache_paths(checksum), (store.item_ids, store.matrix)):
+            # Write to a temporary file first, so other workers never map a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                np.save(file, array)
+            os.replace(tmp_path, path)
+
+        cached = self._load_cached(checksum)
+        return cached if cached is not None else store
+
+    def _prune_cache(self, checksum: str) -> None:
+        """Remove converted stores older than the current one, except the previous version.
+
+        Workers sharing cache_dir may still be loading the previous version,
+        or may have converted a newer one already, those stores are kept.
+        """
+        # Paths and modification time of the files of each version
+        versions: Dict[str, Tuple[List[str], float]] = {}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            paths, newest = versions.setdefault(name.split(".")[0], ([], 0.0))
+            paths.append(path)
+            versions[name.split(".")[0]] = (paths, max(newest, mtime))
+
+        if checksum not in versions:
+            return
+        current = versions[checksum][1]
+        older = sorted((mtime, version) for version, (_, mtime) in versions.items() if mtime < current)
+        for _, version in older[:-1]:
+            for path in versions[version][0]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,359 @@
+"""Approximate nearest neighbors index (IVF) on pure NumPy."""
+from typing import Iterator, Optional, Tuple
+
+import time
+import numpy as np
+from scipy.special import logsumexp
+
+
+def _sq_norms(vectors: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", vectors, vectors)
+
+
+def _sq_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Pairwise squared euclidean distances ||a||^2 + ||b||^2 - 2ab."""
+    sq_dist = _sq_norms(a)[:, None] + _sq_norms(b)[None, :] - 2 * a @ b.T
+    return np.maximum(sq_dist, 0, out=sq_dist)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    """Index of the nearest centroid for each vector."""
+    centroids_sq_norms = _sq_norms(centroids)
+    assignments = np.empty(len(vectors), dtype=np.intp)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float64)
+        # ||a||^2 is the same for all centroids, so it is skipped
+        assignments[start:start + block_size] = np.argmin(
+            centroids_sq_norms[None, :] - 2 * block @ centroids.T, axis=1
+        )
+    return assignments
+
+
+# Subsets up to this size are searched exactly, every member is a candidate of every query
+EXACT_SUBSET_SIZE = 2048
+
+
+class IVFIndex:
+    """Inverted file index: k-means coarse quantizer with inverted lists.
+
+    Every row of the catalogue matrix is assigned to its nearest centroid.
+    A query scans only the lists of its ``nprobe`` nearest centroids, so
+    ``nprobe`` trades recall for latency: ``nprobe = n_lists`` is exact.
+
+    Queries are catalogue rows, and candidates can be restricted to a subset
+    of rows (a request group), so group uniqueness reuses the catalogue-wide
+    quantizer without refitting anything. Only lists holding members of the
+    subset are probed, ``nprobe`` is scaled by the catalogue to subset size
+    ratio, and subsets of up to ``EXACT_SUBSET_SIZE`` rows are scanned
+    exactly.
+
+    Parameters
+    ----------
+    matrix: np.ndarray :
+        catalogue embeddings (n_items, dim)
+    centroids: np.ndarray :
+        coarse quantizer centroids (n_lists, dim)
+    assignments: np.ndarray :
+        list index of each catalogue row
+    version: str :
+        version of the store the index was built from
+
+    """
+
+    def __init__(self, matrix: np.ndarray, centroids: np.ndarray, assignments: np.ndarray, version: str = ""):
+        self.matrix = matrix
+        self.centroids = centroids
+        self.assignments = assignments
+        self.version = version
+        self.n_lists = len(centroids)
+
+    @classmethod
+    def build(
+            cls,
+            matrix: np.ndarray,
+            n_lists: Optional[int] = None,
+            n_iter: int = 20,
+            sample_size: Optional[int] = None,
+            seed: int = 0,
+            version: str = "",
+    ) -> "IVFIndex":
+        """Train the coarse quantizer with k-means and fill inverted lists.
+
+        Parameters
+        ----------
+        matrix: np.ndarray :
+            catalogue embeddings (n_items, dim)
+        n_lists: Optional[int] :
+            number of inverted lists (Default value = sqrt(n_items))
+        n_iter: int :
+            number of k-means iterations (Default value = 20)
+        sample_size: Optional[int] :
+            number of rows k-means is trained on (Default value = 64 * n_lists)
+        seed: int :
+            random seed (Default value = 0)
+        version: str :
+            version of the store (Default value = "")
+
+        Returns
+        -------
+        IVFIndex
+            built index
+
+        """
+        n_items = len(matrix)
+        n_lists = min(n_lists or max(int(np.sqrt(n_items)), 1), n_items)
+        sample_size = min(sample_size or 64 * n_lists, n_items)
+        rng = np.random.default_rng(seed)
+
+        sample = np.asarray(matrix[np.sort(rng.choice(n_items, sample_size, replace=False))], dtype=np.float64)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(n_iter):
+            labels = _assign(sample, centroids)
+            counts = np.bincount(labels, minlength=n_lists)
+            order = np.argsort(labels, kind="stable")
+
+            empty = counts == 0
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[~empty]
+            centroids[~empty] = np.add.reduceat(sample[order], starts, axis=0) / counts[~empty, None]
+            # Re-seed empty lists with random sample points
+            centroids[empty] = sample[rng.choice(sample_size, empty.sum())]
+
+        return cls(matrix, centroids, _assign(matrix, centroids), version)
+
+    def _lists(self, subset: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return members grouped by list and list offsets (CSR layout)."""
+        rows = np.arange(len(self.matrix)) if subset is None else np.asarray(subset)
+        labels = self.assignments[rows]
+        order = np.argsort(labels, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=self.n_lists))))
+        return rows[order], offsets
+
+    def _exact_blocks(
+            self, queries: np.ndarray, positions: np.ndarray, candidates: np.ndarray, block_size: int = 1024
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Yield (query positions, candidate rows, squared distances) of all candidates, in blocks."""
+        for start in range(0, len(candidates), 64 * block_size):
+            block_candidates = candidates[start:start + 64 * block_size]
+            candidate_vectors = np.asarray(self.matrix[block_candidates], dtype=np.float64)
+            for query_start in range(0, len(positions), block_size):
+                block_positions = positions[query_start:query_start + block_size]
+                yield block_positions, block_candidates, _sq_distances(queries[block_positions], candidate_vectors)
+
+    def _blocks(
+            self, rows: np.ndarray, nprobe: int, subset: Optional[np.ndarray] = None
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Yield (query positions, candidate rows, squared distances) per probed list."""
+        queries = np.asarray(self.matrix[rows], dtype=np.float64)
+        if subset is not None and len(subset) <= EXACT_SUBSET_SIZE:
+            yield from self._exact_blocks(queries, np.arange(len(rows)), np.asarray(subset))
+            return
+
+        members, offsets = self._lists(subset)
+        # Lists without candidates are not probed, so every probe finds some
+        probe_lists = np.flatnonzero(np.diff(offsets))
+        if subset is not None:
+            # Lists hold a fraction of a subset, a query scans about as many candidates as with the whole catalogue
+            nprobe = -(-nprobe * len(self.matrix) // len(subset))
+        nprobe = min(nprobe, len(probe_lists))
+
+        # nprobe nearest lists of each query
+        if nprobe < len(probe_lists):
+            nearest = np.argpartition(
+                _sq_distances(queries, self.centroids[probe_lists]), nprobe - 1, axis=1
+            )[:, :nprobe]
+            probes = probe_lists[nearest]
+        else:
+            probes = np.tile(probe_lists, (len(rows), 1))
+
+        # Group queries by probed list
+        probed_lists = probes.ravel()
+        query_positions = np.repeat(np.arange(len(rows)), nprobe)
+        order = np.argsort(probed_lists, kind="stable")
+        probed_lists, query_positions = probed_lists[order], query_positions[order]
+        bounds = np.searchsorted(probed_lists, np.arange(self.n_lists + 1))
+
+        for list_id in np.unique(probed_lists):
+            candidates = members[offsets[list_id]:offsets[list_id + 1]]
+            if not len(candidates):
+                continue
+            positions = query_positions[bounds[list_id]:bounds[list_id + 1]]
+            candidate_vectors = np.asarray(self.matrix[candidates], dtype=np.float64)
+            yield positions, candidates, _sq_distances(queries[positions], candidate_vectors)
+
+    def search(
+            self, rows: np.ndarray, k: int, nprobe: int = 8, subset: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate k nearest neighbors of catalogue rows, excluding the row itself.
+
+        Parameters
+        ----------
+        rows: np.ndarray :
+            catalogue rows to query
+        k: int :
+            number of neighbors
+        nprobe: int :
+            number of lists scanned per query (Default value = 8)
+        subset: Optional[np.ndarray] :
+            candidate rows, None for the whole catalogue (Default value = None)
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            distances (n_queries, k), sorted ascending, inf if there are less than k candidates
+            neighbor rows (n_queries, k), -1 if there are less than k candidates
+
+        """
+        rows = np.asarray(rows)
+        best_dist = np.full((len(rows), k), np.inf)
+        best_rows = np.full((len(rows), k), -1, dtype=np.intp)
+
+        def merge(positions: np.ndarray, candidates: np.ndarray, sq_dist: np.ndarray) -> None:
+            sq_dist[rows[positions, None] == candidates[None, :]] = np.inf
+
+            merged_dist = np.hstack((best_dist[positions], sq_dist))
+            merged_rows = np.hstack((best_rows[positions], np.broadcast_to(candidates, sq_dist.shape)))
+            top_k = np.argpartition(merged_dist, k - 1, axis=1)[:, :k]
+            best_dist[positions] = np.take_along_axis(merged_dist, top_k, axis=1)
+            best_rows[positions] = np.take_along_axis(merged_rows, top_k, axis=1)
+
+        for block in self._blocks(rows, nprobe, subset):
+            merge(*block)
+
+        # Queries whose probed lists held less than k candidates are searched exactly
+        short = np.flatnonzero(np.isinf(best_dist).any(axis=1))
+        candidates = np.arange(len(self.matrix)) if subset is None else np.asarray(subset)
+        if len(short) and len(candidates) > EXACT_SUBSET_SIZE:
+            best_dist[short], best_rows[short] = np.inf, -1
+            queries = np.asarray(self.matrix[rows], dtype=np.float64)
+            for block in self._exact_blocks(queries, short, candidates):
+                merge(*block)
+
+        order = np.argsort(best_dist, axis=1)
+        return np.sqrt(np.take_along_axis(best_dist, order, axis=1)), np.take_along_axis(best_rows, order, axis=1)
+
+    def kernel_log_density(
+            self, rows: np.ndarray, nprobe: int = 8, bandwidth: float = 1.0, subset: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Approximate Gaussian KDE log-density of catalogue rows.
+
+        The kernel sum is truncated to candidates in the probed lists; far
+        away items, which contribute almost nothing, are skipped. It is
+        exact for subsets of up to EXACT_SUBSET_SIZE rows.
+
+        Parameters
+        ----------
+        rows: np.ndarray :
+            catalogue rows to estimate density for
+        nprobe: int :
+            number of lists scanned per query (Default value = 8)
+        bandwidth: float :
+            kernel bandwidth (Default value = 1.0)
+        subset: Optional[np.ndarray] :
+            rows the density is estimated on, None for the whole catalogue (Default value = None)
+
+        Returns
+        -------
+        np.ndarray
+            log-density estimates
+
+        """
+        rows = np.asarray(rows)
+        log_density = np.full(len(rows), -np.inf)
+
+        for positions, _, sq_dist in self._blocks(rows, nprobe, subset):
+            log_density[positions] = np.logaddexp(
+                log_density[positions], logsumexp(-0.5 * sq_dist / bandwidth**2, axis=1)
+            )
+
+        n_items = len(self.matrix) if subset is None else len(subset)
+        dim = self.matrix.shape[1]
+        log_density -= np.log(n_items) + 0.5 * dim * np.log(2 * np.pi) + dim * np.log(bandwidth)
+
+        return log_density
+
+
+def benchmark_recall(
+        matrix: np.ndarray, k: int = 10, nprobe_grid: Tuple[int, ...] = (1, 2, 4, 8, 16, 32), n_queries: int = 1000
+) -> None:
+    """Print recall@k and query latency of IVFIndex against exact NearestNeighbors."""
+    from sklearn.neighbors import NearestNeighbors
+
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(matrix), min(n_queries, len(matrix)), replace=False)
+
+    start = time.perf_counter()
+    exact = NearestNeighbors(n_neighbors=k).fit(matrix).kneighbors(matrix[rows], k + 1)[1]
+    exact_time = time.perf_counter() - start
+    # Drop the query itself
+    exact = np.array([[row for row in neighbors if row != query][:k] for query, neighbors in zip(rows, exact)])
+
+    start = time.perf_counter()
+    index = IVFIndex.build(matrix)
+    print(f"build: {time.perf_counter() - start:.2f}s, n_lists={index.n_lists}")
+    print(f"exact: {exact_time * 1e3 / len(rows):.3f} ms/query")
+
+    for nprobe in nprobe_grid:
+        start = time.perf_counter()
+        approx = index.search(rows, k, nprobe)[1]
+        elapsed = time.perf_counter() - start
+        recall = np.mean([len(np.intersect1d(a, e)) / k for a, e in zip(approx, exact)])
+        print(f"nprobe={nprobe:>3}: recall@{k}={recall:.3f}, {elapsed * 1e3 / len(rows):.3f} ms/query")
+
+
+def benchmark_subset(
+        matrix: np.ndarray,
+        group_sizes: Tuple[int, ...] = (30, 1000, 5000, 20000),
+        k: int = 10,
+        nprobe_grid: Tuple[int, ...] = (1, 8, 32),
+        n_queries: int = 300,
+        bandwidth: float = 1.0,
+) -> None:
+    """Print recall@k and KDE error of IVFIndex on random groups, as the endpoints search them (subset=group).
+
+    KDE error is the mean relative error of the density of the group members.
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    rng = np.random.default_rng(0)
+    index = IVFIndex.build(matrix)
+    dim = matrix.shape[1]
+
+    for group_size in group_sizes:
+        group = np.sort(rng.choice(len(matrix), group_size, replace=False))
+        queries = group[rng.choice(group_size, min(n_queries, group_size), replace=False)]
+        k_group = min(k, group_size - 1)
+
+        vectors = np.asarray(matrix[group], dtype=np.float64)
+        exact = group[NearestNeighbors(n_neighbors=k_group + 1).fit(vectors).kneighbors(matrix[queries])[1]]
+        exact = np.array([
+            [row for row in neighbors if row != query][:k_group] for query, neighbors in zip(queries, exact)
+        ])
+        exact_log_density = logsumexp(
+            -0.5 * _sq_distances(np.asarray(matrix[queries], dtype=np.float64), vectors) / bandwidth**2, axis=1
+        ) - np.log(group_size) - 0.5 * dim * np.log(2 * np.pi) - dim * np.log(bandwidth)
+
+        for nprobe in nprobe_grid:
+            start = time.perf_counter()
+            approx = index.search(queries, k_group, nprobe, subset=group)[1]
+            elapsed = time.perf_counter() - start
+            recall = np.mean([len(np.intersect1d(a, e)) / k_group for a, e in zip(approx, exact)])
+            log_density = index.kernel_log_density(queries, nprobe, bandwidth, subset=group)
+            kde_error = np.mean(np.abs(np.expm1(log_density - exact_log_density)))
+            print(
+                f"group={group_size:>6} nprobe={nprobe:>3}: recall@{k_group}={recall:.3f}, "
+                f"KDE error={kde_error:.4f}, {elapsed * 1e3 / len(queries):.3f} ms/query"
+            )
+
+
+def main() -> None:
+    """Run recall benchmarks on synthetic clustered embeddings"""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=4, size=(1000, 32))
+    matrix = centers[rng.integers(len(centers), size=100_000)] + rng.normal(size=(100_000, 32))
+    benchmark_recall(matrix.astype(np.float32))
+    benchmark_subset(matrix.astype(np.float32))
+
+
+if __name__ == "__main__":
+    main()
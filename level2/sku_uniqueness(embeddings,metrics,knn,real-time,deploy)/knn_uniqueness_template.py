@@ -1,17 +1,45 @@
 """Solution's template for user."""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import os
 from sklearn.neighbors import NearestNeighbors
 import numpy as np
 
+from ivf_index import IVFIndex
+
 
-def knn_uniqueness(embeddings: np.ndarray, num_neighbors: int) -> np.ndarray:
+def knn_uniqueness(
+        embeddings: np.ndarray,
+        num_neighbors: int,
+        method: str = "sklearn",
+        block_size: int = 1024,
+        n_jobs: Optional[int] = None,
+        index: Optional[IVFIndex] = None,
+        rows: Optional[np.ndarray] = None,
+        nprobe: int = 8,
+) -> np.ndarray:
     """Estimate uniqueness of each item in item embeddings group. Based on knn.
 
     Parameters
     ----------
     embeddings: np.ndarray :
-        embeddings group 
+        embeddings group
     num_neighbors: int :
-        number of neighbors to estimate uniqueness    
+        number of neighbors to estimate uniqueness
+    method: str :
+        "sklearn" (NearestNeighbors), "blocked" (chunked brute force)
+        or "ivf" (approximate, IVFIndex) (Default value = "sklearn")
+    block_size: int :
+        rows per distance block for "blocked" method, see blocked_knn_uniqueness (Default value = 1024)
+    n_jobs: Optional[int] :
+        number of threads for "blocked" method, None for MAX_JOBS (Default value = None)
+    index: Optional[IVFIndex] :
+        catalogue index for "ivf" method (Default value = None)
+    rows: Optional[np.ndarray] :
+        catalogue rows of the group for "ivf" method (Default value = None)
+    nprobe: int :
+        number of lists scanned per item for "ivf" method (Default value = 8)
 
     Returns
     -------
@@ -19,7 +47,91 @@ def knn_uniqueness(embeddings: np.ndarray, num_neighbors: int) -> np.ndarray:
         uniqueness estimates
 
     """
-    nn = NearestNeighbors(n_neighbors=num_neighbors).fit(embeddings)
-    uniqueness = nn.kneighbors()[0].mean(axis=1)
+    if method == "sklearn":
+        nn = NearestNeighbors(n_neighbors=num_neighbors).fit(embeddings)
+        uniqueness = nn.kneighbors()[0].mean(axis=1)
+    elif method == "blocked":
+        uniqueness = blocked_knn_uniqueness(embeddings, num_neighbors, block_size, n_jobs)
+    elif method == "ivf":
+        uniqueness = index.search(rows, num_neighbors, nprobe, subset=rows)[0].mean(axis=1)
+    else:
+        raise NotImplementedError("Only sklearn, blocked and ivf methods currently supported!")
+
+    return uniqueness
+
+
+# Default number of threads of blocked_knn_uniqueness, each one holds a distance block
+MAX_JOBS = 4
+
+
+def blocked_knn_uniqueness(
+        embeddings: np.ndarray,
+        num_neighbors: int,
+        block_size: int = 1024,
+        n_jobs: Optional[int] = None,
+        max_memory: int = 1 << 30,
+) -> np.ndarray:
+    """Mean distance to num_neighbors nearest neighbors, computed blockwise.
+
+    Each block of rows gets its squared distances to the whole group
+    (||a||^2 + ||b||^2 - 2ab, computed in place in the matrix product
+    output), the item itself is excluded and the top-k is selected with an
+    in-place partition. So a block holds a single block_size x n_items
+    float64 array and peak memory is about n_jobs * block_size * n_items * 8
+    bytes on top of embeddings. block_size is reduced to keep it within
+    max_memory. Blocks run on a thread pool, NumPy releases the GIL inside
+    the matrix products and partitions.
+
+    Parameters
+    ----------
+    embeddings: np.ndarray :
+        embeddings group
+    num_neighbors: int :
+        number of neighbors to estimate uniqueness
+    block_size: int :
+        rows per distance block (Default value = 1024)
+    n_jobs: Optional[int] :
+        number of threads, None for min(MAX_JOBS, number of cores) (Default value = None)
+    max_memory: int :
+        bytes of distance blocks of all threads (Default value = 1 GB)
+
+    Returns
+    -------
+    np.ndarray
+        uniqueness estimates
+
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    n_items = len(embeddings)
+    if not 0 < num_neighbors < n_items:
+        raise ValueError(
+            f"Expected 0 < num_neighbors < n_items, got num_neighbors={num_neighbors}, n_items={n_items}"
+        )
+
+    if n_jobs is None:
+        n_jobs = min(MAX_JOBS, os.cpu_count() or 1)
+    block_size = max(1, min(block_size, max_memory // (n_jobs * n_items * 8)))
+
+    sq_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+    uniqueness = np.empty(n_items)
+
+    def process_block(start: int) -> None:
+        stop = min(start + block_size, n_items)
+        sq_dist = embeddings[start:stop] @ embeddings.T
+        sq_dist *= -2
+        sq_dist += sq_norms[None, :]
+        sq_dist += sq_norms[start:stop, None]
+        np.maximum(sq_dist, 0, out=sq_dist)
+
+        # Exclude the item itself, as NearestNeighbors.kneighbors() does
+        rows = np.arange(stop - start)
+        sq_dist[rows, rows + start] = np.inf
+
+        sq_dist.partition(num_neighbors - 1, axis=1)
+        uniqueness[start:stop] = np.sqrt(sq_dist[:, :num_neighbors]).mean(axis=1)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        # list() propagates exceptions from workers
+        list(executor.map(process_block, range(0, n_items, block_size)))
 
     return uniqueness
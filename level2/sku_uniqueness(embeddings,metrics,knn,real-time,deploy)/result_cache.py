@@ -0,0 +1,85 @@
+"""LRU/TTL cache for uniqueness and diversity results."""
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import threading
+import time
+
+
+class ResultCache:
+    """Thread-safe LRU cache bounded by number of entries and memory.
+
+    Parameters
+    ----------
+    max_entries: int :
+        maximum number of cached results (Default value = 10000)
+    max_bytes: int :
+        maximum total size of cached results in bytes (Default value = 64 MB)
+    ttl: Optional[float] :
+        time to live of a result in seconds, None for no expiration (Default value = None)
+
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 << 20, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        # key: (value, size in bytes, expiration time)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return cached value or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._pop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int) -> None:
+        """Cache value, evicting least recently used entries if needed."""
+        if nbytes > self.max_bytes:
+            return
+
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, nbytes, expires)
+            self.nbytes += nbytes
+
+            while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Drop all cached values, counters are kept."""
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        """Return cache counters."""
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _pop(self, key: Hashable) -> None:
+        self.nbytes -= self._data.pop(key)[1]
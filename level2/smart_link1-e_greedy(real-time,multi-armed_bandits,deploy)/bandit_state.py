@@ -0,0 +1,573 @@
+"""Compact state store shared by the bandit services."""
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+
+import time
+import numpy as np
+
+
+# Number of last clicks kept for feedback
+CLICKS_CAPACITY = 1_000_000
+# Clicks older than this (seconds) can't get feedback anymore
+CLICKS_TTL = 24 * 3600
+
+EMPTY = np.iinfo(np.int64).min
+# Kinds of logged events
+SAMPLE, FEEDBACK = 0, 1
+_MASK64 = (1 << 64) - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def allocate_local(name: str, size: int, dtype: type, fill: float) -> np.ndarray:
+    """Allocate process-local state array."""
+    return np.full(size, fill, dtype=dtype)
+
+
+class ClickTable:
+    """Bounded click_id -> offer index table.
+
+    Open addressing hash table with linear probing on NumPy arrays. Clicks
+    are also kept in a ring buffer in insertion order: when ``capacity`` is
+    reached, or the oldest click is older than ``ttl`` seconds, it is
+    evicted, so memory stays flat whatever the traffic is.
+
+    Not thread-safe: the services update it from the event loop only.
+
+    Parameters
+    ----------
+    capacity: int :
+        maximum number of clicks kept (Default value = CLICKS_CAPACITY)
+    ttl: Optional[float] :
+        clicks retention in seconds, None to keep until evicted by capacity (Default value = CLICKS_TTL)
+    allocate: Callable :
+        allocator of state arrays, see allocate_local (Default value = allocate_local)
+    prefix: str :
+        prefix of arrays names passed to allocate (Default value = "clicks")
+
+    """
+
+    def __init__(
+            self,
+            capacity: int = CLICKS_CAPACITY,
+            ttl: Optional[float] = CLICKS_TTL,
+            allocate: Callable = allocate_local,
+            prefix: str = "clicks",
+    ):
+        self.capacity = capacity
+        self.ttl = ttl
+
+        # Load factor is kept below 0.5
+        self._bits = max(int(np.ceil(np.log2(2 * capacity))), 1)
+        self._mask = (1 << self._bits) - 1
+        self._keys = allocate(f"{prefix}_keys", 1 << self._bits, np.int64, EMPTY)
+        self._values = allocate(f"{prefix}_values", 1 << self._bits, np.int32, -1)
+        # Insertion number of the key, to tell stale ring entries from live ones
+        self._inserted_at = allocate(f"{prefix}_inserted_at", 1 << self._bits, np.int64, -1)
+        # 1 if the click already got feedback
+        self._claimed = allocate(f"{prefix}_claimed", 1 << self._bits, np.int8, 0)
+
+        self._ring = allocate(f"{prefix}_ring", capacity, np.int64, EMPTY)
+        self._ring_times = allocate(f"{prefix}_ring_times", capacity, np.float64, 0)
+        # Number of inserted clicks, clicks in the ring and keys in the table
+        self._meta = allocate(f"{prefix}_meta", 3, np.int64, 0)
+
+    @property
+    def _n_inserted(self) -> int:
+        return int(self._meta[0])
+
+    @_n_inserted.setter
+    def _n_inserted(self, value: int) -> None:
+        self._meta[0] = value
+
+    @property
+    def _n_ring(self) -> int:
+        return int(self._meta[1])
+
+    @_n_ring.setter
+    def _n_ring(self, value: int) -> None:
+        self._meta[1] = value
+
+    @property
+    def _n_keys(self) -> int:
+        return int(self._meta[2])
+
+    @_n_keys.setter
+    def _n_keys(self, value: int) -> None:
+        self._meta[2] = value
+
+    def __len__(self) -> int:
+        return self._n_keys
+
+    def _home(self, key: int) -> int:
+        """Fibonacci hashing of a single key."""
+        return ((key * _GOLDEN) & _MASK64) >> (64 - self._bits)
+
+    def _homes(self, keys: np.ndarray) -> np.ndarray:
+        """Fibonacci hashing of an array of keys."""
+        hashed = keys.astype(np.uint64) * np.uint64(_GOLDEN)
+        return (hashed >> np.uint64(64 - self._bits)).astype(np.int64)
+
+    def _find(self, key: int) -> int:
+        """Return slot of the key or -1."""
+        slot = self._home(key)
+        while True:
+            slot_key = self._keys[slot]
+            if slot_key == key:
+                return slot
+            if slot_key == EMPTY:
+                return -1
+            slot = (slot + 1) & self._mask
+
+    def _delete(self, slot: int) -> None:
+        """Delete key in slot, shifting back the following keys of its cluster."""
+        keys = self._keys
+        hole = slot
+        slot = (slot + 1) & self._mask
+        while keys[slot] != EMPTY:
+            home = self._home(int(keys[slot]))
+            # Move the key into the hole unless its home lies cyclically in (hole, slot]
+            if (slot - home) & self._mask >= (slot - hole) & self._mask:
+                keys[hole] = keys[slot]
+                self._values[hole] = self._values[slot]
+                self._inserted_at[hole] = self._inserted_at[slot]
+                self._claimed[hole] = self._claimed[slot]
+                hole = slot
+            slot = (slot + 1) & self._mask
+        keys[hole] = EMPTY
+        self._n_keys -= 1
+
+    def _evict_oldest(self) -> None:
+        number = self._n_inserted - self._n_ring
+        key = int(self._ring[number % self.capacity])
+        slot = self._find(key)
+        # The key may have been inserted again later, then the ring entry is stale
+        if slot >= 0 and self._inserted_at[slot] == number:
+            self._delete(slot)
+        self._n_ring -= 1
+
+    def expire(self, now: Optional[float] = None) -> None:
+        """Evict clicks older than ttl."""
+        if self.ttl is None:
+            return
+        deadline = (time.time() if now is None else now) - self.ttl
+        while self._n_ring and self._ring_times[(self._n_inserted - self._n_ring) % self.capacity] < deadline:
+            self._evict_oldest()
+
+    def insert(self, click_id: int, offer_index: int, now: Optional[float] = None) -> None:
+        """Store offer index of the click."""
+        now = time.time() if now is None else now
+        self.expire(now)
+        if self._n_ring == self.capacity:
+            self._evict_oldest()
+
+        slot = self._home(click_id)
+        while self._keys[slot] != EMPTY and self._keys[slot] != click_id:
+            slot = (slot + 1) & self._mask
+        if self._keys[slot] == EMPTY:
+            self._n_keys += 1
+
+        number = self._n_inserted
+        self._keys[slot] = click_id
+        self._values[slot] = offer_index
+        self._inserted_at[slot] = number
+        self._claimed[slot] = 0
+
+        self._ring[number % self.capacity] = click_id
+        self._ring_times[number % self.capacity] = now
+        self._n_inserted += 1
+        self._n_ring += 1
+
+    def get(self, click_id: int) -> int:
+        """Return offer index of the click or -1 if it is unknown or evicted."""
+        self.expire()
+        slot = self._find(click_id)
+        return int(self._values[slot]) if slot >= 0 else -1
+
+    def claim(self, click_id: int) -> Tuple[int, bool]:
+        """Mark the click as having got feedback.
+
+        Returns
+        -------
+        Tuple[int, bool]
+            offer index of the click or -1 if it is unknown or evicted
+            whether the click had already got feedback
+
+        """
+        self.expire()
+        slot = self._find(click_id)
+        if slot < 0:
+            return -1, False
+        duplicate = bool(self._claimed[slot])
+        self._claimed[slot] = 1
+        return int(self._values[slot]), duplicate
+
+    def _slots(self, click_ids: np.ndarray) -> np.ndarray:
+        """Vectorized _find: slots of the keys, -1 for missing ones."""
+        result = np.full(len(click_ids), -1, dtype=np.int64)
+        slots = self._homes(click_ids)
+        active = np.arange(len(click_ids))
+
+        # All keys advance one probe step at a time
+        while len(active):
+            slot_keys = self._keys[slots[active]]
+            hit = slot_keys == click_ids[active]
+            result[active[hit]] = slots[active[hit]]
+            active = active[~hit & (slot_keys != EMPTY)]
+            slots[active] = (slots[active] + 1) & self._mask
+
+        return result
+
+    def lookup(self, click_ids: np.ndarray) -> np.ndarray:
+        """Vectorized get: offer indices of the clicks, -1 for unknown ones."""
+        self.expire()
+        slots = self._slots(np.asarray(click_ids, dtype=np.int64))
+        return np.where(slots >= 0, self._values[slots], -1).astype(np.int64)
+
+    def claim_many(self, click_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectorized claim.
+
+        A click repeated within click_ids is a duplicate except for its first
+        occurrence.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            offer indices of the clicks, -1 for unknown ones
+            duplicates mask
+
+        """
+        self.expire()
+        click_ids = np.asarray(click_ids, dtype=np.int64)
+        slots = self._slots(click_ids)
+        known = slots >= 0
+
+        first = np.zeros(len(click_ids), dtype=bool)
+        first[np.unique(click_ids, return_index=True)[1]] = True
+        duplicate = known & (~first | (self._claimed[slots] == 1))
+
+        self._claimed[slots[known]] = 1
+        return np.where(known, self._values[slots], -1).astype(np.int64), duplicate
+
+    def clear(self) -> None:
+        """Remove all clicks."""
+        self._keys.fill(EMPTY)
+        self._meta.fill(0)
+
+    arrays = ("_keys", "_values", "_inserted_at", "_claimed", "_ring", "_ring_times", "_meta")
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """Return copies of the table arrays."""
+        return {name: getattr(self, name).copy() for name in self.arrays}
+
+    def restore(self, arrays: Dict[str, np.ndarray]) -> None:
+        """Load table arrays from snapshot of a table of the same capacity."""
+        for name in self.arrays:
+            array = getattr(self, name)
+            if array.shape != arrays[name].shape:
+                raise ValueError(f"Snapshot of {name} has shape {arrays[name].shape}, expected {array.shape}")
+            array[:] = arrays[name]
+
+
+class BanditState:
+    """Per-offer counters in NumPy arrays and a bounded click table.
+
+    Offer ids are mapped to dense indices, counters of offer ``i`` are
+    ``clicks[i]``, ``conversions[i]`` and ``rewards[i]``. Arrays grow by
+    doubling when new offers appear.
+
+    ``rpc[i]`` and ``inv_sqrt_clicks[i]`` (1 / sqrt(clicks), 0 without
+    clicks) are updated on every event, so policies score any subset of
+    offers with a single vectorized expression.
+
+    Parameters
+    ----------
+    clicks_capacity: int :
+        maximum number of clicks kept for feedback (Default value = CLICKS_CAPACITY)
+    clicks_ttl: Optional[float] :
+        clicks retention in seconds (Default value = CLICKS_TTL)
+    offers_capacity: int :
+        initial size of counters arrays (Default value = 64)
+
+    """
+
+    # State is kept in process memory
+    shared = False
+    # Time of counted events, logged with them, see windowed_state.py
+    clock = staticmethod(time.time)
+
+    # (name, dtype) of 1D counters, or (name, dtype, columns) of 2D ones
+    counters = (
+        ("offer_ids", np.int64),
+        ("clicks", np.int64),
+        ("conversions", np.int64),
+        ("rewards", np.float64),
+        ("rpc", np.float64),
+        ("inv_sqrt_clicks", np.float64),
+    )
+
+    def __init__(
+            self,
+            clicks_capacity: int = CLICKS_CAPACITY,
+            clicks_ttl: Optional[float] = CLICKS_TTL,
+            offers_capacity: int = 64,
+    ):
+        self.offers_capacity = offers_capacity
+        self.click_offers = ClickTable(clicks_capacity, clicks_ttl, self._allocate)
+        for name, dtype, *columns in self.counters:
+            width = columns[0] if columns else 1
+            array = self._allocate(name, offers_capacity * width, dtype, 0)
+            setattr(self, name, array.reshape(offers_capacity, width) if columns else array)
+        # Number of offers and total number of clicks
+        self._meta = self._allocate("meta", 2, np.int64, 0)
+        # Optional EventLog, events are appended to it after they are applied
+        self.log = None
+
+        # dictionary of offer_id: its index in counters arrays
+        self.offer_index: Dict[int, int] = {}
+        self._sorted_ids = np.zeros(0, dtype=np.int64)
+        self._sorted_indices = np.zeros(0, dtype=np.int64)
+
+    def _allocate(self, name: str, size: int, dtype: type, fill: float) -> np.ndarray:
+        return allocate_local(name, size, dtype, fill)
+
+    @property
+    def n_offers(self) -> int:
+        return int(self._meta[0])
+
+    @n_offers.setter
+    def n_offers(self, value: int) -> None:
+        self._meta[0] = value
+
+    @property
+    def total_clicks(self) -> int:
+        return int(self._meta[1])
+
+    @total_clicks.setter
+    def total_clicks(self, value: int) -> None:
+        self._meta[1] = value
+
+    def clear(self) -> None:
+        """Reset all counters and clicks."""
+        self.click_offers.clear()
+        for name, *_ in self.counters:
+            getattr(self, name).fill(0)
+        self._meta.fill(0)
+
+        self.offer_index = {}
+        self._sorted_ids = np.zeros(0, dtype=np.int64)
+        self._sorted_indices = np.zeros(0, dtype=np.int64)
+
+    def _grow(self) -> None:
+        size = 2 * len(self.clicks)
+        for name, *_ in self.counters:
+            array = getattr(self, name)
+            grown = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def _register(self, offer_id: int) -> int:
+        if self.n_offers == len(self.clicks):
+            self._grow()
+        idx = self.offer_index[offer_id] = self.n_offers
+        self.offer_ids[idx] = offer_id
+        self.n_offers += 1
+        return idx
+
+    def _reindex(self) -> None:
+        """Rebuild sorted ids used for vectorized lookup, new offers are rare."""
+        order = np.argsort(self.offer_ids[:self.n_offers], kind="stable")
+        self._sorted_ids = self.offer_ids[order]
+        self._sorted_indices = order
+
+    def _find(self, offer_id: int) -> int:
+        """Return counters index of the offer or -1."""
+        return self.offer_index.get(offer_id, -1)
+
+    def index(self, offer_ids: Iterable[int]) -> np.ndarray:
+        """Return counters indices of offers, registering new ones."""
+        offer_ids = np.asarray(offer_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_ids, offer_ids), max(self.n_offers - 1, 0))
+        found = self._sorted_ids[positions] == offer_ids if self.n_offers else np.zeros(len(offer_ids), dtype=bool)
+
+        if not found.all():
+            for offer_id in np.unique(offer_ids[~found]).tolist():
+                self._register(offer_id)
+            self._reindex()
+            return self.index(offer_ids)
+
+        return self._sorted_indices[positions]
+
+    def sample(self, click_id: int, offer_id: int) -> None:
+        """Register click sent to the offer."""
+        idx = self.offer_index.get(offer_id)
+        if idx is None:
+            idx = self._register(offer_id)
+            self._reindex()
+        now = time.time()
+        self.total_clicks += 1
+        self.click_offers.insert(click_id, idx, now)
+        self._count_click(idx)
+        if self.log is not None:
+            self.log.append(SAMPLE, click_id, offer_id, now, self.clock())
+
+    def sample_many(self, click_ids: np.ndarray, offer_ids: np.ndarray) -> None:
+        """Register clicks sent to the offers, offer_ids[i] is the offer of click_ids[i]."""
+        times = np.full(len(click_ids), time.time())
+        self._sample_many(click_ids, offer_ids, times)
+        if self.log is not None:
+            self.log.append_many(SAMPLE, click_ids, offer_ids, times, np.full(len(click_ids), self.clock()))
+
+    def _sample_many(
+            self,
+            click_ids: np.ndarray,
+            offer_ids: np.ndarray,
+            times: np.ndarray,
+            event_times: Optional[np.ndarray] = None,
+    ) -> None:
+        indices = self.index(offer_ids)
+        self.total_clicks += len(indices)
+        for click_id, idx, now in zip(np.asarray(click_ids, dtype=np.int64).tolist(), indices.tolist(), times.tolist()):
+            self.click_offers.insert(click_id, idx, now)
+        self._add_clicks(indices, event_times)
+
+    def feedback(self, click_id: int, reward: float) -> Tuple[int, bool]:
+        """Register reward of the click, as feedback_many does for a single click.
+
+        Returns
+        -------
+        Tuple[int, bool]
+            offer_id of the click
+            whether the click had already got feedback, then the reward is skipped
+
+        """
+        idx, duplicate = self.click_offers.claim(click_id)
+        if idx < 0:
+            raise KeyError(click_id)
+
+        offer_id = int(self.offer_ids[idx])
+        if duplicate:
+            return offer_id, True
+        self._count_reward(idx, reward)
+        if self.log is not None:
+            self.log.append(FEEDBACK, click_id, offer_id, reward, self.clock())
+        return offer_id, False
+
+    def feedback_many(self, click_ids: np.ndarray, rewards: np.ndarray) -> Dict[str, np.ndarray]:
+        """Register rewards of the clicks.
+
+        Unknown (or evicted) clicks and clicks which already got feedback,
+        before or earlier in the batch, are skipped.
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            offer_ids: offer of each click, -1 if it was skipped
+            unknown: unknown clicks mask
+            duplicate: duplicate clicks mask
+
+        """
+        indices, duplicate = self.click_offers.claim_many(click_ids)
+        accepted = (indices >= 0) & ~duplicate
+        rewards = np.asarray(rewards, dtype=np.float64)[accepted]
+        self._count_rewards(indices[accepted], rewards)
+
+        offer_ids = np.where(accepted, self.offer_ids[indices], -1)
+        if self.log is not None:
+            times = np.full(len(rewards), self.clock())
+            self.log.append_many(FEEDBACK, np.asarray(click_ids)[accepted], offer_ids[accepted], rewards, times)
+        return {
+            "offer_ids": offer_ids,
+            "unknown": indices < 0,
+            "duplicate": duplicate,
+        }
+
+    def count(self, offer_ids: np.ndarray, rewards: np.ndarray) -> None:
+        """Count clicks sent to the offers and their rewards at once, without click table (offline replay)."""
+        indices = self.index(offer_ids)
+        self.total_clicks += len(indices)
+        self._add_clicks(indices)
+        self._count_rewards(indices, np.asarray(rewards, dtype=np.float64))
+
+    def replay(
+            self, kinds: np.ndarray, click_ids: np.ndarray, offer_ids: np.ndarray, values: np.ndarray, times: np.ndarray
+    ) -> None:
+        """Apply logged events, values are click times of samples and rewards of feedbacks.
+
+        Runs of events of the same kind are applied in one vectorized step.
+        Events are counted at their logged times (on the state clock), so
+        windowed and discounted counters are restored as if there was no
+        restart. Logged feedbacks were accepted, so they are counted even if
+        the click is already evicted.
+        """
+        bounds = np.flatnonzero(np.diff(kinds)) + 1
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(kinds)]):
+            if kinds[start] == SAMPLE:
+                self._sample_many(click_ids[start:stop], offer_ids[start:stop], values[start:stop], times[start:stop])
+            else:
+                self.click_offers.claim_many(click_ids[start:stop])
+                self._count_rewards(self.index(offer_ids[start:stop]), values[start:stop], times[start:stop])
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """Return copies of counters and click table arrays."""
+        arrays = {name: getattr(self, name)[:self.n_offers].copy() for name, *_ in self.counters}
+        arrays["meta"] = self._meta.copy()
+        arrays.update({f"clicks{name}": array for name, array in self.click_offers.snapshot().items()})
+        return arrays
+
+    def restore(self, arrays: Dict[str, np.ndarray]) -> None:
+        """Load state from snapshot."""
+        self.clear()
+        for offer_id in arrays["offer_ids"].tolist():
+            self._register(offer_id)
+        self._reindex()
+        for name, *_ in self.counters:
+            getattr(self, name)[:len(arrays[name])] = arrays[name]
+        self._meta[:] = arrays["meta"]
+        self.click_offers.restore({name: arrays[f"clicks{name}"] for name in self.click_offers.arrays})
+
+    def _count_click(self, idx: int) -> None:
+        self.clicks[idx] += 1
+        self._update_scores(idx)
+
+    def _add_clicks(self, indices: np.ndarray, times: Optional[np.ndarray] = None) -> None:
+        # times of replayed events, counters without time ignore them
+        np.add.at(self.clicks, indices, 1)
+        self._update_scores(np.unique(indices))
+
+    def _count_reward(self, idx: int, reward: float) -> None:
+        self.conversions[idx] += bool(reward)
+        self.rewards[idx] += reward
+        self._update_scores(idx)
+
+    def _count_rewards(self, indices: np.ndarray, rewards: np.ndarray, times: Optional[np.ndarray] = None) -> None:
+        np.add.at(self.conversions, indices, rewards != 0)
+        np.add.at(self.rewards, indices, rewards)
+        self._update_scores(np.unique(indices))
+
+    def _update_scores(self, idx: Union[int, np.ndarray]) -> None:
+        if isinstance(idx, np.ndarray):
+            clicks = self.clicks[idx]
+            positive = clicks > 0
+            # Counters may be fractional, see windowed_state.py
+            clicks = np.where(positive, clicks, 1)
+            self.rpc[idx] = self.rewards[idx] / clicks
+            self.inv_sqrt_clicks[idx] = np.where(positive, 1 / np.sqrt(clicks), 0.0)
+            return
+
+        clicks = self.clicks[idx]
+        self.rpc[idx] = self.rewards[idx] / (clicks or 1)
+        self.inv_sqrt_clicks[idx] = 1 / np.sqrt(clicks) if clicks else 0.0
+
+    def stats(self, offer_id: int) -> dict:
+        """Return offer's statistics"""
+        idx = self._find(offer_id)
+        clicks = self.clicks[idx].item() if idx >= 0 else 0
+        conversions = self.conversions[idx].item() if idx >= 0 else 0
+        reward = self.rewards[idx].item() if idx >= 0 else 0
+        return {
+            "offer_id": offer_id,
+            "clicks": clicks,
+            "conversions": conversions,
+            "reward": reward,
+            "cr": conversions / (clicks or 1),
+            "rpc": reward / (clicks or 1),
+        }
@@ -0,0 +1,75 @@
+"""Benchmark of /sample/ latency versus number of candidate offers."""
+from typing import Callable, List
+
+import asyncio
+import time
+import numpy as np
+
+import epsilon_greedy
+import greedy
+import upper_confidence_bound
+
+
+def warm_up(module, n_offers: int, n_clicks: int = 5000) -> None:
+    """Fill service state with random clicks and rewards."""
+    rng = np.random.default_rng(0)
+    module.state.clear()
+    for click_id in range(n_clicks):
+        module.state.sample(click_id, int(rng.integers(n_offers)))
+        if rng.random() < 0.1:
+            module.state.feedback(click_id, float(rng.exponential()))
+
+
+def measure(sample: Callable, offer_ids: str, n_calls: int) -> float:
+    """Return mean latency of sample endpoint in microseconds."""
+
+    async def run() -> float:
+        start = time.perf_counter()
+        for click_id in range(10**9, 10**9 + n_calls):
+            await sample(click_id=click_id, offer_ids=offer_ids)
+        return time.perf_counter() - start
+
+    return asyncio.run(run()) / n_calls * 1e6
+
+
+def per_offer_loop(module, offers_ids: np.ndarray) -> int:
+    """Arm selection of the previous implementation: stats() per offer."""
+    return max(offers_ids.tolist(), key=lambda x: module.stats(x)['rpc'])
+
+
+def vectorized(module, offers_ids: np.ndarray) -> int:
+    """Arm selection of the current implementation."""
+    offers_indices = module.state.index(offers_ids)
+    return int(offers_ids[np.argmax(module.state.rpc[offers_indices])])
+
+
+def selection_latency(select: Callable, module, offers_ids: np.ndarray, n_calls: int) -> float:
+    """Return mean latency of greedy arm selection in microseconds."""
+    start = time.perf_counter()
+    for _ in range(n_calls):
+        select(module, offers_ids)
+    return (time.perf_counter() - start) / n_calls * 1e6
+
+
+def main(n_offers_grid: List[int] = (2, 10, 100, 1000, 10000), n_calls: int = 2000) -> None:
+    """Print sample latency table"""
+    print("Latency, us/call. /sample/ endpoints, and greedy arm selection alone")
+    print(f"{'offers':>8} {'greedy':>10} {'eps-greedy':>10} {'ucb':>10} {'vectorized':>11} {'per-offer':>10}")
+    for n_offers in n_offers_grid:
+        offers_ids = np.arange(n_offers)
+        offer_ids = ",".join(map(str, offers_ids))
+
+        latencies = []
+        for module in (greedy, epsilon_greedy, upper_confidence_bound):
+            warm_up(module, n_offers)
+            latencies.append(measure(module.sample, offer_ids, n_calls))
+
+        warm_up(greedy, n_offers)
+        latencies.append(selection_latency(vectorized, greedy, offers_ids, n_calls))
+        latencies.append(selection_latency(per_offer_loop, greedy, offers_ids, n_calls))
+
+        print(f"{n_offers:>8} " + " ".join(f"{latency:>10.1f}" for latency in latencies))
+
+
+if __name__ == "__main__":
+    main()
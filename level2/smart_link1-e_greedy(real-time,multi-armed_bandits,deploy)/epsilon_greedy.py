@@ -1,45 +1,70 @@
+from typing import Tuple
+
+import numpy as np
 import uvicorn
-from fastapi import FastAPI
-from random import choice, random
+from fastapi import FastAPI, Request
+
+from bandit_state import BanditState
+from feedback import register_feedback, register_feedback_batch
+from shared_state import make_state
 
 
 app = FastAPI()
 
-# dictionary of offer_id: its count as value
-offers_count = {}
-# dictionary of click_id: its corresponding offer_id
-click_offer_dict = {}
-# dictionary of offer_id: number of its conversions
-offers_conversions = {}
-# dictionary of offer_id: sum of its rewards
-offers_rewards = {}
+# Per-offer counters and bounded click_id: offer_id table, shared by workers if
+# BANDIT_SHARED_STATE is set. Endpoints changing it are async, so it is only
+# updated from the event loop.
+state = make_state("epsilon_greedy")
+rng = np.random.default_rng()
+
+
+def select(
+        state: BanditState,
+        offers_indices: np.ndarray,
+        size: int = 1,
+        epsilon: float = 0.1,
+        rng: np.random.Generator = rng,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Epsilon-Greedy choice for the next size clicks
+
+    Returns positions of chosen offers among candidates and mask of random choices
+    """
+    random_choice = rng.random(size) < epsilon
+    positions = np.where(
+        random_choice, rng.integers(len(offers_indices), size=size), np.argmax(state.rpc[offers_indices])
+    )
+    return positions, random_choice
 
 
 @app.on_event("startup")
 def startup_event():
-    offers_count.clear()
-    click_offer_dict.clear()
-    offers_conversions.clear()
-    offers_rewards.clear()
+    # Shared state is initialized by the first worker, the others attach to it
+    if not state.shared:
+        state.clear()
+    # Restore state from the last snapshot and event log tail
+    if state.log is not None:
+        state.log.open(state)
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if state.log is not None:
+        state.log.close()
 
 
 @app.get("/sample/")
-def sample(click_id: int, offer_ids: str, epsilon: float = 0.1) -> dict:
+async def sample(click_id: int, offer_ids: str, epsilon: float = 0.1) -> dict:
     """Epsilon-Greedy sampling"""
     # Parse offer IDs
-    offers_ids = [int(offer) for offer in offer_ids.split(",")]
+    offers_ids = np.array(offer_ids.split(","), dtype=np.int64)
+    offers_indices = state.index(offers_ids)
 
     # Epsilon-Greedy sample offer ID
-    p = random()
-    if p < epsilon:
-        sampler = 'random'
-        offer_id = choice(offers_ids)
-    else:
-        sampler = 'greedy'
-        offer_id = max(offers_ids, key=lambda x: stats(x)['rpc'])
+    positions, random_choice = select(state, offers_indices, epsilon=epsilon)
+    sampler = 'random' if random_choice[0] else 'greedy'
+    offer_id = int(offers_ids[positions[0]])
 
-    offers_count[offer_id] = offers_count.get(offer_id, 0) + 1
-    click_offer_dict[click_id] = offer_id
+    state.sample(click_id, offer_id)
 
     # Prepare response
     response = {
@@ -52,36 +77,23 @@ def sample(click_id: int, offer_ids: str, epsilon: float = 0.1) -> dict:
 
 
 @app.put("/feedback/")
-def feedback(click_id: int, reward: float) -> dict:
+async def feedback(click_id: int, reward: float) -> dict:
     """Get feedback for particular click"""
-    # Response body consists of click ID
-    # and accepted click status (True/False)
+    # Response body consists of click ID, offer ID, conversion status
+    # and whether the click already got feedback (then the reward is skipped)
+    return register_feedback(state, click_id, reward)
 
-    is_conversion = bool(reward)
-    offer_id = click_offer_dict[click_id]
-    offers_conversions[offer_id] = offers_conversions.get(offer_id, 0) + is_conversion
-    offers_rewards[offer_id] = offers_rewards.get(offer_id, 0) + reward
 
-    response = {
-        "click_id": click_id,
-        "offer_id": offer_id,
-        "is_conversion": is_conversion,
-        "reward": reward,
-    }
-    return response
+@app.post("/feedback/batch")
+async def feedback_batch(request: Request) -> dict:
+    """Get feedback for many clicks, see feedback.register_feedback_batch"""
+    return await register_feedback_batch(state, request)
 
 
 @app.get("/offer_ids/{offer_id}/stats/")
 def stats(offer_id: int) -> dict:
     """Return offer's statistics"""
-    response = {
-        "offer_id": offer_id,
-        "clicks": offers_count.get(offer_id, 0),
-        "conversions": offers_conversions.setdefault(offer_id, 0),
-        "reward": offers_rewards.setdefault(offer_id, 0),
-        "cr": offers_conversions[offer_id] / offers_count.get(offer_id, 1),
-        "rpc": offers_rewards[offer_id] / offers_count.get(offer_id, 1),
-    }
+    response = state.stats(offer_id)
     return response
 
 
@@ -0,0 +1,248 @@
+"""Write-ahead log of bandit events and state snapshots."""
+from typing import List, Optional, Tuple
+from zipfile import BadZipFile
+
+import os
+import threading
+import time
+import numpy as np
+
+from bandit_state import BanditState
+
+
+# Packed log record, 33 bytes: value is click time of samples and reward of feedbacks,
+# time is the state clock time the event was counted at
+RECORD = np.dtype([("kind", "u1"), ("click_id", "<i8"), ("offer_id", "<i8"), ("value", "<f8"), ("time", "<f8")])
+
+
+class EventLog:
+    """Append-only binary log of sample and feedback events with periodic snapshots.
+
+    Request handlers only append records to an in-memory buffer. A writer
+    thread writes the buffer every ``flush_interval`` seconds with a single
+    write and fsync (group commit), so at most the last ``flush_interval``
+    seconds of events are lost on crash. Log is split into segments named
+    by the number of their first record.
+
+    Every ``snapshot_interval`` seconds the state arrays are copied (a
+    memcpy on the event loop, ~10 ms for a million clicks) and the writer
+    thread saves them as ``snapshot-<number of records>.npz``, then deletes
+    older snapshots and log segments. Startup loads the latest snapshot and
+    replays the log tail.
+
+    Parameters
+    ----------
+    directory: str :
+        log and snapshots directory
+    flush_interval: float :
+        seconds between group commits (Default value = 0.05)
+    snapshot_interval: float :
+        seconds between snapshots (Default value = 60)
+    segment_size: int :
+        log segment size in bytes before it is rotated (Default value = 64 MB)
+
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            flush_interval: float = 0.05,
+            snapshot_interval: float = 60,
+            segment_size: int = 64 << 20,
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        # Number of appended and of written records
+        self.n_records = 0
+        self._n_written = 0
+        # Records tuples and arrays not written yet, and snapshot to save
+        self._pending: list = []
+        self._snapshot: Optional[Tuple[int, dict]] = None
+        self._lock = threading.Lock()
+
+        self._state: Optional[BanditState] = None
+        self._next_snapshot = float("inf")
+        self._segment = None
+        self._segment_bytes = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+
+    def append(self, kind: int, click_id: int, offer_id: int, value: float, event_time: float) -> None:
+        """Log single event."""
+        with self._lock:
+            self._pending.append((kind, click_id, offer_id, value, event_time))
+            self.n_records += 1
+        self._maybe_snapshot()
+
+    def append_many(
+            self, kind: int, click_ids: np.ndarray, offer_ids: np.ndarray, values: np.ndarray, times: np.ndarray
+    ) -> None:
+        """Log events of the same kind."""
+        records = np.empty(len(click_ids), dtype=RECORD)
+        records["kind"] = kind
+        records["click_id"] = click_ids
+        records["offer_id"] = offer_ids
+        records["value"] = values
+        records["time"] = times
+        with self._lock:
+            self._pending.append(records)
+            self.n_records += len(records)
+        self._maybe_snapshot()
+
+    def _maybe_snapshot(self) -> None:
+        if time.monotonic() >= self._next_snapshot:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Copy state arrays, the writer thread saves them."""
+        arrays = self._state.snapshot()
+        with self._lock:
+            self._snapshot = (self.n_records, arrays)
+        self._next_snapshot = time.monotonic() + self.snapshot_interval
+        self._wake.set()
+
+    def open(self, state: BanditState) -> None:
+        """Restore state from the latest snapshot and the log tail, then start logging its events."""
+        self.recover(state)
+        self._state = state
+        state.log = self
+        self._next_snapshot = time.monotonic() + self.snapshot_interval
+        self._stop.clear()
+        self._writer = threading.Thread(target=self._write_loop, name="event-log-writer", daemon=True)
+        self._writer.start()
+
+    def close(self) -> None:
+        """Save final snapshot, write pending records and stop the writer thread."""
+        if self._writer is None:
+            return
+        self.snapshot()
+        self._stop.set()
+        self._wake.set()
+        self._writer.join()
+        self._writer = None
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def recover(self, state: BanditState) -> int:
+        """Load the latest readable snapshot into state and replay the log after it.
+
+        Returns
+        -------
+        int
+            number of replayed records
+
+        """
+        n_snapshot = 0
+        for n_records, path in reversed(self._files("snapshot-", ".npz")):
+            try:
+                with np.load(path) as snapshot:
+                    state.restore({name: snapshot[name] for name in snapshot.files})
+                n_snapshot = n_records
+                break
+            except (OSError, ValueError, KeyError, BadZipFile):
+                # Partially written snapshot, take the previous one
+                state.clear()
+
+        tail = []
+        n_records = n_snapshot
+        for start, path in self._files("", ".wal"):
+            # A torn last record is dropped
+            records = np.fromfile(path, dtype=RECORD, count=os.path.getsize(path) // RECORD.itemsize)
+            tail.append(records[max(n_snapshot - start, 0):])
+            n_records = max(n_records, start + len(records))
+
+        tail = np.concatenate(tail) if tail else np.zeros(0, dtype=RECORD)
+        if len(tail):
+            state.replay(tail["kind"], tail["click_id"], tail["offer_id"], tail["value"], tail["time"])
+
+        self.n_records = self._n_written = n_records
+        return len(tail)
+
+    def _files(self, prefix: str, suffix: str) -> List[Tuple[int, str]]:
+        """(number, path) of files named <prefix><number><suffix>, sorted by number."""
+        files = []
+        for name in os.listdir(self.directory):
+            number = name[len(prefix):-len(suffix)]
+            if name.startswith(prefix) and name.endswith(suffix) and number.isdigit():
+                files.append((int(number), os.path.join(self.directory, name)))
+        return sorted(files)
+
+    def _write_loop(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+            snapshot, self._snapshot = self._snapshot, None
+
+        if pending:
+            data = self._serialize(pending)
+            if self._segment is None or self._segment_bytes >= self.segment_size:
+                self._rotate()
+            self._segment.write(data)
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._segment_bytes += len(data)
+            self._n_written += len(data) // RECORD.itemsize
+
+        if snapshot is not None:
+            self._save_snapshot(*snapshot)
+
+    @staticmethod
+    def _serialize(pending: list) -> bytes:
+        chunks = []
+        records = []
+        for item in pending:
+            if isinstance(item, tuple):
+                records.append(item)
+                continue
+            if records:
+                chunks.append(np.array(records, dtype=RECORD))
+                records = []
+            chunks.append(item)
+        if records:
+            chunks.append(np.array(records, dtype=RECORD))
+        return b"".join(chunk.tobytes() for chunk in chunks)
+
+    def _rotate(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+        # A file with this name can only hold a torn record, it is overwritten
+        self._segment = open(os.path.join(self.directory, f"{self._n_written:020d}.wal"), "wb")
+        self._segment_bytes = 0
+        self._sync_directory()
+
+    def _save_snapshot(self, n_records: int, arrays: dict) -> None:
+        path = os.path.join(self.directory, f"snapshot-{n_records:020d}.npz")
+        with open(path + ".tmp", "wb") as file:
+            np.savez(file, **arrays)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        self._sync_directory()
+
+        # Older snapshots and segments holding only records before the snapshot aren't needed anymore
+        for number, old in self._files("snapshot-", ".npz"):
+            if number < n_records:
+                os.remove(old)
+        segments = self._files("", ".wal")
+        for (_, old), (next_start, _) in zip(segments[:-1], segments[1:]):
+            if next_start <= n_records:
+                os.remove(old)
+
+    def _sync_directory(self) -> None:
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
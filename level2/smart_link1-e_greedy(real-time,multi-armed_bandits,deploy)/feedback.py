@@ -0,0 +1,53 @@
+"""Feedback endpoints bodies, shared by bandit services."""
+import numpy as np
+from fastapi import HTTPException, Request
+
+from bandit_state import BanditState
+
+
+def register_feedback(state: BanditState, click_id: int, reward: float) -> dict:
+    """Register reward of the click and prepare response of the feedback endpoint.
+
+    A click which already got feedback (e.g. in a batch) is reported as duplicate,
+    its reward is not counted again.
+    """
+    offer_id, duplicate = state.feedback(click_id, reward)
+    response = {
+        "click_id": click_id,
+        "offer_id": offer_id,
+        "is_conversion": bool(reward) and not duplicate,
+        "reward": reward,
+        "duplicate": duplicate,
+    }
+    return response
+
+
+async def register_feedback_batch(state: BanditState, request: Request) -> dict:
+    """Register rewards of the clicks and prepare response of the batch feedback endpoint.
+
+    Body: {"click_ids": [click_id, ...], "rewards": [reward, ...]}
+    Unknown clicks and clicks which already got feedback are skipped and reported.
+    """
+    try:
+        body = await request.json()
+        # Floats would be silently truncated and bools taken for 0 and 1
+        if not all(type(click_id) is int for click_id in body["click_ids"]):
+            raise ValueError("click ids must be integers")
+        clicks_ids = np.array(body["click_ids"], dtype=np.int64)
+        rewards = np.array(body["rewards"], dtype=np.float64)
+    except (ValueError, TypeError, KeyError, OverflowError):
+        raise HTTPException(status_code=422, detail={"error": "invalid feedback batch body"})
+
+    if clicks_ids.ndim != 1 or clicks_ids.shape != rewards.shape:
+        raise HTTPException(status_code=422, detail={"error": "invalid feedback batch body"})
+
+    result = state.feedback_many(clicks_ids, rewards)
+    accepted = result["offer_ids"] >= 0
+
+    response = {
+        "accepted": int(accepted.sum()),
+        "conversions": int((rewards[accepted] != 0).sum()),
+        "unknown": clicks_ids[result["unknown"]].tolist(),
+        "duplicate": clicks_ids[result["duplicate"]].tolist(),
+    }
+    return response
@@ -0,0 +1,256 @@
+"""Shared-memory bandit state for multi-worker deployments."""
+from contextlib import ExitStack, contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import fcntl
+import os
+import tempfile
+import numpy as np
+
+from bandit_state import CLICKS_CAPACITY, CLICKS_TTL, BanditState, ClickTable
+from event_log import EventLog
+from windowed_state import DiscountedBanditState, WindowedBanditState
+
+
+# Lock file bytes: state creation, click table, offers table, then offer counters stripes
+_INIT_LOCK, _CLICKS_LOCK, _OFFERS_LOCK, _STRIPES_START = 0, 1, 2, 3
+
+
+class FileLocks:
+    """Inter-process striped locks: byte-range locks on a lock file.
+
+    fcntl locks belong to a process, so they don't exclude threads of the
+    same process from each other. The services only update state from the
+    event loop, one event at a time per worker.
+
+    Parameters
+    ----------
+    path: str :
+        path to the lock file
+
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    @contextmanager
+    def lock(self, stripe: Optional[int]) -> Iterator[None]:
+        """Hold exclusive lock on the stripe, or on all stripes if stripe is None."""
+        length, start = (0, 0) if stripe is None else (1, stripe)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+
+class SharedBanditState(BanditState):
+    """BanditState in POSIX shared memory, shared by all workers on the host.
+
+    Every array lives in its own ``multiprocessing.shared_memory`` segment
+    named ``<name>-<array>``. The first process creates and initializes the
+    segments, the others attach to them, so N uvicorn workers learn one
+    bandit. Segments outlive the workers, ``unlink`` removes them.
+
+    Offers are mapped to counters indices with a shared hash table, counters
+    are fixed-size. Updates of the click table hold one lock, counters
+    updates hold the lock of the offer's stripe, so workers scoring
+    different offers don't wait for each other. Reads for arm selection are
+    lock-free.
+
+    Parameters
+    ----------
+    name: str :
+        name of the state, same for all workers
+    clicks_capacity: int :
+        maximum number of clicks kept for feedback (Default value = CLICKS_CAPACITY)
+    clicks_ttl: Optional[float] :
+        clicks retention in seconds (Default value = CLICKS_TTL)
+    offers_capacity: int :
+        maximum number of offers (Default value = 4096)
+    n_stripes: int :
+        number of offer counters locks (Default value = 64)
+
+    """
+
+    shared = True
+
+    def __init__(
+            self,
+            name: str,
+            clicks_capacity: int = CLICKS_CAPACITY,
+            clicks_ttl: Optional[float] = CLICKS_TTL,
+            offers_capacity: int = 4096,
+            n_stripes: int = 64,
+    ):
+        self.name = name
+        self.n_stripes = n_stripes
+        self._segments: List[SharedMemory] = []
+        self._locks = FileLocks(os.path.join(tempfile.gettempdir(), f"{name}.lock"))
+
+        # Workers start concurrently, the first one creates segments
+        with self._locks.lock(_INIT_LOCK):
+            super().__init__(clicks_capacity, clicks_ttl, offers_capacity)
+            self.offer_table = ClickTable(offers_capacity, None, self._allocate, prefix="offers")
+
+    def _allocate(self, name: str, size: int, dtype: type, fill: float) -> np.ndarray:
+        nbytes = size * np.dtype(dtype).itemsize
+        try:
+            segment = SharedMemory(f"{self.name}-{name}", create=True, size=nbytes)
+            created = True
+        except FileExistsError:
+            segment = SharedMemory(f"{self.name}-{name}")
+            created = False
+            if segment.size < nbytes:
+                raise ValueError(f"Shared segment {segment.name} is smaller than expected, unlink old state")
+
+        # Otherwise the resource tracker removes segments when any worker exits
+        resource_tracker.unregister(segment._name, "shared_memory")
+        self._segments.append(segment)
+
+        array = np.ndarray(size, dtype=dtype, buffer=segment.buf)
+        if created:
+            array.fill(fill)
+        return array
+
+    def _stripe(self, idx: int) -> int:
+        return _STRIPES_START + idx % self.n_stripes
+
+    def unlink(self) -> None:
+        """Remove shared memory segments of the state."""
+        for segment in self._segments:
+            # unlink() unregisters the segment from the resource tracker
+            resource_tracker.register(segment._name, "shared_memory")
+            segment.unlink()
+
+    def clear(self) -> None:
+        """Reset all counters and clicks."""
+        with self._locks.lock(None):
+            self.click_offers.clear()
+            self.offer_table.clear()
+            for name, *_ in self.counters:
+                getattr(self, name).fill(0)
+            self._meta.fill(0)
+
+    def _grow(self) -> None:
+        raise RuntimeError(f"Shared state is full: more than {self.offers_capacity} offers")
+
+    def _find(self, offer_id: int) -> int:
+        return self.offer_table.get(offer_id)
+
+    def index(self, offer_ids: Iterable[int]) -> np.ndarray:
+        """Return counters indices of offers, registering new ones."""
+        offer_ids = np.asarray(offer_ids, dtype=np.int64)
+        indices = self.offer_table.lookup(offer_ids)
+
+        missing = indices < 0
+        if missing.any():
+            with self._locks.lock(_OFFERS_LOCK):
+                for offer_id in np.unique(offer_ids[missing]).tolist():
+                    # Another worker may have registered it meanwhile
+                    if self.offer_table.get(offer_id) < 0:
+                        if self.n_offers == self.offers_capacity:
+                            self._grow()
+                        idx = self.n_offers
+                        self.offer_ids[idx] = offer_id
+                        self.offer_table.insert(offer_id, idx)
+                        self.n_offers += 1
+            indices = self.offer_table.lookup(offer_ids)
+
+        return indices
+
+    def sample(self, click_id: int, offer_id: int) -> None:
+        """Register click sent to the offer."""
+        idx = int(self.index((offer_id,))[0])
+        with self._locks.lock(_CLICKS_LOCK):
+            self.total_clicks += 1
+            self.click_offers.insert(click_id, idx)
+        with self._locks.lock(self._stripe(idx)):
+            self._count_click(idx)
+
+    def sample_many(self, click_ids: np.ndarray, offer_ids: np.ndarray) -> None:
+        """Register clicks sent to the offers, offer_ids[i] is the offer of click_ids[i]."""
+        indices = self.index(offer_ids)
+        with self._locks.lock(_CLICKS_LOCK):
+            self.total_clicks += len(indices)
+            for click_id, idx in zip(np.asarray(click_ids, dtype=np.int64).tolist(), indices.tolist()):
+                self.click_offers.insert(click_id, idx)
+
+        unique = np.unique(indices)
+        with self._lock_stripes(unique):
+            np.add.at(self.clicks, indices, 1)
+            self._update_scores(unique)
+
+    def _lock_stripes(self, indices: np.ndarray) -> ExitStack:
+        """Hold locks of the offers stripes, taken in ascending order."""
+        stack = ExitStack()
+        for stripe in sorted({self._stripe(idx) for idx in indices.tolist()}):
+            stack.enter_context(self._locks.lock(stripe))
+        return stack
+
+    def feedback(self, click_id: int, reward: float) -> Tuple[int, bool]:
+        """Register reward of the click, see BanditState.feedback."""
+        with self._locks.lock(_CLICKS_LOCK):
+            idx, duplicate = self.click_offers.claim(click_id)
+        if idx < 0:
+            raise KeyError(click_id)
+
+        if not duplicate:
+            with self._locks.lock(self._stripe(idx)):
+                self._count_reward(idx, reward)
+        return int(self.offer_ids[idx]), duplicate
+
+    def feedback_many(self, click_ids: np.ndarray, rewards: np.ndarray) -> Dict[str, np.ndarray]:
+        """Register rewards of the clicks, see BanditState.feedback_many."""
+        with self._locks.lock(_CLICKS_LOCK):
+            indices, duplicate = self.click_offers.claim_many(click_ids)
+
+        accepted = (indices >= 0) & ~duplicate
+        with self._lock_stripes(np.unique(indices[accepted])):
+            self._count_rewards(indices[accepted], np.asarray(rewards, dtype=np.float64)[accepted])
+        return {
+            "offer_ids": np.where(accepted, self.offer_ids[indices], -1),
+            "unknown": indices < 0,
+            "duplicate": duplicate,
+        }
+
+
+def make_state(service: str) -> BanditState:
+    """Return bandit state of the service.
+
+    If BANDIT_SHARED_STATE environment variable is set, the state is shared
+    by all workers of the service on the host, e.g.
+    ``BANDIT_SHARED_STATE=smart_link uvicorn greedy:app --workers 4``.
+    Otherwise it is process-local.
+
+    If BANDIT_EVENT_LOG is set, events of process-local state are logged to
+    ``$BANDIT_EVENT_LOG/<service>``, the service restores the state from it
+    at startup (``state.log.open(state)``).
+
+    Process-local counters cover all time, unless BANDIT_WINDOW (window
+    length) or BANDIT_HALF_LIFE (discount half-life) is set, in seconds.
+    """
+    prefix = os.environ.get("BANDIT_SHARED_STATE")
+    log_directory = os.environ.get("BANDIT_EVENT_LOG")
+    window = os.environ.get("BANDIT_WINDOW")
+    half_life = os.environ.get("BANDIT_HALF_LIFE")
+    if prefix and (log_directory or window or half_life):
+        raise NotImplementedError("Only process-local state currently supports event log and recent counters!")
+    if window and half_life:
+        raise ValueError("Set either BANDIT_WINDOW or BANDIT_HALF_LIFE")
+
+    if prefix:
+        return SharedBanditState(f"{prefix}-{service}")
+
+    if window:
+        state = WindowedBanditState(float(window))
+    elif half_life:
+        state = DiscountedBanditState(float(half_life))
+    else:
+        state = BanditState()
+    if log_directory:
+        state.log = EventLog(os.path.join(log_directory, service))
+    return state
@@ -0,0 +1,254 @@
+"""Offline replay of the bandit policies over synthetic or recorded click streams."""
+from typing import Callable, Dict, Iterator, List, Optional
+
+import inspect
+import time
+import numpy as np
+
+import epsilon_greedy
+import greedy
+import thompson_sampling
+import upper_confidence_bound
+from bandit_state import BanditState
+from windowed_state import DiscountedBanditState, WindowedBanditState
+
+
+# select(state, offers_indices, size, **params) of the services
+POLICIES = {
+    "greedy": greedy.select,
+    "epsilon_greedy": epsilon_greedy.select,
+    "upper_confidence_bound": upper_confidence_bound.select,
+    "thompson_sampling": thompson_sampling.select,
+}
+
+
+def synthetic_stream(
+        n_clicks: int = 1_000_000,
+        n_offers: int = 100,
+        n_links: int = 20,
+        n_candidates: int = 10,
+        batch_size: int = 1000,
+        seed: int = 0,
+        shift_every: Optional[int] = None,
+) -> Iterator[Dict[str, np.ndarray]]:
+    """Clicks on smart links with random candidate offers.
+
+    Offer ``i`` converts with probability ``cr[i]`` ~ Beta(2, 50), reward of a
+    conversion is exponential with mean ~ LogNormal(2, 0.5). Each batch holds
+    clicks of one link, same seed gives the same stream, so policies are
+    compared on common random numbers.
+
+    Parameters
+    ----------
+    n_clicks: int :
+        number of clicks (Default value = 1_000_000)
+    n_offers: int :
+        number of offers (Default value = 100)
+    n_links: int :
+        number of smart links (Default value = 20)
+    n_candidates: int :
+        candidate offers per link (Default value = 10)
+    batch_size: int :
+        clicks per batch (Default value = 1000)
+    seed: int :
+        random seed (Default value = 0)
+    shift_every: Optional[int] :
+        number of clicks after which offers conversion rates are shuffled,
+        None for stationary offers (Default value = None)
+
+    Yields
+    ------
+    Dict[str, np.ndarray]
+        candidates: (n_candidates,) offer ids
+        rewards: (batch_size, n_candidates) reward of each click for each candidate
+        expected: (n_candidates,) expected reward per click of candidates
+
+    """
+    rng = np.random.default_rng(seed)
+    cr = rng.beta(2, 50, n_offers)
+    mean_reward = rng.lognormal(2, 0.5, n_offers)
+    rpc = cr * mean_reward
+    links = np.array([rng.choice(n_offers, n_candidates, replace=False) for _ in range(n_links)])
+
+    for start in range(0, n_clicks, batch_size):
+        if shift_every and start and start % shift_every < batch_size:
+            cr = rng.permutation(cr)
+            rpc = cr * mean_reward
+        size = min(batch_size, n_clicks - start)
+        candidates = links[rng.integers(n_links)]
+        converted = rng.random((size, n_candidates)) < cr[candidates]
+        rewards = converted * rng.exponential(mean_reward[candidates], (size, n_candidates))
+        yield {"candidates": candidates, "rewards": rewards, "expected": rpc[candidates]}
+
+
+def recorded_stream(
+        links: np.ndarray,
+        offers: np.ndarray,
+        rewards: np.ndarray,
+        candidates: Dict[int, np.ndarray],
+        batch_size: int = 1000,
+) -> Iterator[Dict[str, np.ndarray]]:
+    """Logged clicks for replay evaluation.
+
+    Only the reward of the logged offer is known, so a click counts only if
+    the policy chooses the logged offer (Li et al. replay method). The
+    estimate is unbiased if offers were logged uniformly at random.
+
+    Parameters
+    ----------
+    links: np.ndarray :
+        smart link of each click
+    offers: np.ndarray :
+        logged offer of each click
+    rewards: np.ndarray :
+        reward of each click
+    candidates: Dict[int, np.ndarray] :
+        candidate offer ids of each link
+    batch_size: int :
+        clicks per chunk, a chunk is split into batches by link (Default value = 1000)
+
+    Yields
+    ------
+    Dict[str, np.ndarray]
+        candidates: offer ids
+        rewards: (clicks, candidates) rewards, NaN for not logged offers
+
+    """
+    for start in range(0, len(links), batch_size):
+        chunk = slice(start, start + batch_size)
+        chunk_links = links[chunk]
+        for link in np.unique(chunk_links).tolist():
+            mask = chunk_links == link
+            link_offers = offers[chunk][mask]
+            batch_rewards = np.full((mask.sum(), len(candidates[link])), np.nan)
+            logged = link_offers[:, None] == candidates[link][None, :]
+            batch_rewards[logged] = rewards[chunk][mask][logged.any(axis=1)]
+            yield {"candidates": candidates[link], "rewards": batch_rewards}
+
+
+def simulate(
+        policy: str,
+        stream: Callable[[], Iterator[Dict[str, np.ndarray]]],
+        seed: int = 0,
+        state: Optional[BanditState] = None,
+        **params,
+) -> Dict[str, float]:
+    """Replay stream through the policy of a service, without HTTP.
+
+    Decisions for a batch are made with the state at its start, then clicks
+    and rewards of the batch are counted at once, as with delayed feedback.
+
+    Parameters
+    ----------
+    policy: str :
+        name of the service, key of POLICIES
+    stream: Callable[[], Iterator[Dict[str, np.ndarray]]] :
+        function returning batches iterator, see synthetic_stream
+    seed: int :
+        random seed of the policy (Default value = 0)
+    state: Optional[BanditState] :
+        initial state, e.g. WindowedBanditState, None for empty BanditState (Default value = None)
+    **params :
+        parameters of the policy, e.g. epsilon or c
+
+    Returns
+    -------
+    Dict[str, float]
+        decisions: number of counted decisions
+        rpc: reward per click
+        regret: expected reward lost to the best candidates, NaN without expected rewards
+        decisions_per_sec: policy and state update throughput
+
+    """
+    if policy not in POLICIES:
+        raise NotImplementedError(f"Only {', '.join(POLICIES)} policies currently supported!")
+    select = POLICIES[policy]
+    if "rng" in inspect.signature(select).parameters:
+        params["rng"] = np.random.default_rng(seed)
+
+    if state is None:
+        state = BanditState(clicks_capacity=1)
+    decisions, reward, regret, elapsed = 0, 0.0, 0.0, 0.0
+
+    for batch in stream():
+        candidates, rewards = batch["candidates"], batch["rewards"]
+        start = time.perf_counter()
+
+        offers_indices = state.index(candidates)
+        positions = select(state, offers_indices, len(rewards), **params)
+        if isinstance(positions, tuple):
+            # greedy policies also return random choice mask
+            positions = positions[0]
+
+        chosen_rewards = rewards[np.arange(len(rewards)), positions]
+        shown = ~np.isnan(chosen_rewards)
+        state.count(candidates[positions[shown]], chosen_rewards[shown])
+
+        elapsed += time.perf_counter() - start
+        decisions += int(shown.sum())
+        reward += float(chosen_rewards[shown].sum())
+        if "expected" in batch:
+            expected = batch["expected"]
+            regret += float((expected.max() - expected[positions]).sum())
+        else:
+            regret = np.nan
+
+    return {
+        "decisions": decisions,
+        "rpc": reward / max(decisions, 1),
+        "regret": regret,
+        "decisions_per_sec": decisions / max(elapsed, 1e-9),
+    }
+
+
+def tune(
+        policy: str, stream: Callable[[], Iterator[Dict[str, np.ndarray]]], param: str, values: List[float]
+) -> List[Dict[str, float]]:
+    """Simulate the policy for each value of its parameter, on the same stream."""
+    return [dict(simulate(policy, stream, **{param: value}), **{param: value}) for value in values]
+
+
+def clicks_clock_state(state_class: type, horizon: float) -> BanditState:
+    """Windowed or discounted state measuring time in clicks, for simulation"""
+    state = state_class(horizon, clock=lambda: state.total_clicks, clicks_capacity=1)
+    return state
+
+
+def main(n_clicks: int = 2_000_000) -> None:
+    """Print comparison of the policies, tuning of epsilon and UCB constant, and of counters modes"""
+
+    def stream() -> Iterator[Dict[str, np.ndarray]]:
+        return synthetic_stream(n_clicks)
+
+    def row(name: str, result: Dict[str, float]) -> str:
+        return (
+            f"{name:>34} {result['rpc']:>8.4f} {result['regret']:>12.1f} "
+            f"{result['decisions_per_sec'] / 1e6:>10.2f}"
+        )
+
+    print(f"{n_clicks} synthetic clicks")
+    print(f"{'policy':>34} {'rpc':>8} {'regret':>12} {'M dec/s':>10}")
+    for policy in POLICIES:
+        print(row(policy, simulate(policy, stream)))
+    for result in tune("epsilon_greedy", stream, "epsilon", [0.01, 0.05, 0.1, 0.2]):
+        print(row(f"epsilon_greedy eps={result['epsilon']}", result))
+    for result in tune("upper_confidence_bound", stream, "c", [0.1, 0.5, 1.5, 4]):
+        print(row(f"upper_confidence_bound c={result['c']}", result))
+
+    def drifting() -> Iterator[Dict[str, np.ndarray]]:
+        return synthetic_stream(n_clicks, shift_every=n_clicks // 4)
+
+    horizon = n_clicks // 20
+    print(f"Conversion rates shuffled every {n_clicks // 4} clicks, window and half-life of {horizon} clicks")
+    for policy in ("epsilon_greedy", "upper_confidence_bound"):
+        print(row(f"{policy} lifetime", simulate(policy, drifting)))
+        print(row(f"{policy} window", simulate(
+            policy, drifting, state=clicks_clock_state(WindowedBanditState, horizon)
+        )))
+        print(row(f"{policy} discounted", simulate(
+            policy, drifting, state=clicks_clock_state(DiscountedBanditState, horizon / 2)
+        )))
+
+
+if __name__ == "__main__":
+    main()
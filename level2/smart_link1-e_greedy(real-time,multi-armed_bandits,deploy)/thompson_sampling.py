@@ -0,0 +1,148 @@
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+
+from bandit_state import BanditState
+from feedback import register_feedback, register_feedback_batch
+from shared_state import make_state
+
+
+app = FastAPI()
+
+# Per-offer counters and bounded click_id: offer_id table, shared by workers if
+# BANDIT_SHARED_STATE is set. Endpoints changing it are async, so it is only
+# updated from the event loop.
+state = make_state("thompson_sampling")
+rng = np.random.default_rng()
+
+# Priors: conversion rate ~ Beta(1, 1), reward of a conversion ~ Exponential
+# with rate ~ Gamma(1, 1), i.e. prior mean reward of about 1
+PRIOR_ALPHA, PRIOR_BETA = 1.0, 1.0
+PRIOR_SHAPE, PRIOR_RATE = 1.0, 1.0
+
+
+def thompson_sampling(
+        state: BanditState, offers_indices: np.ndarray, n_draws: int = 1, rng: np.random.Generator = rng
+) -> np.ndarray:
+    """Returns rpc (revenue per click) samples from offers posteriors, shape (n_draws, n_offers).
+
+    Conjugate posteriors are computed from the offers counters:
+    conversion rate ~ Beta(alpha + conversions, beta + clicks - conversions),
+    rate of conversion reward ~ Gamma(shape + conversions, rate + rewards).
+    Sampled rpc is conversion rate / reward rate.
+    """
+    conversions = state.conversions[offers_indices]
+    clicks = state.clicks[offers_indices]
+    rewards = state.rewards[offers_indices]
+    size = (n_draws, len(offers_indices))
+
+    cr = rng.beta(PRIOR_ALPHA + conversions, PRIOR_BETA + np.maximum(clicks - conversions, 0), size)
+    reward_rate = rng.gamma(PRIOR_SHAPE + conversions, 1 / (PRIOR_RATE + rewards), size)
+
+    return cr / reward_rate
+
+
+def select(
+        state: BanditState, offers_indices: np.ndarray, size: int = 1, rng: np.random.Generator = rng
+) -> np.ndarray:
+    """Thompson sampling choice for the next size clicks, returns positions of chosen offers among candidates"""
+    # One posterior draw per click, all of them from a single call
+    return np.argmax(thompson_sampling(state, offers_indices, size, rng), axis=1)
+
+
+@app.on_event("startup")
+def startup_event():
+    # Shared state is initialized by the first worker, the others attach to it
+    if not state.shared:
+        state.clear()
+    # Restore state from the last snapshot and event log tail
+    if state.log is not None:
+        state.log.open(state)
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if state.log is not None:
+        state.log.close()
+
+
+@app.get("/sample/")
+async def sample(click_id: int, offer_ids: str) -> dict:
+    """Thompson sampling"""
+    # Parse offer IDs
+    offers_ids = np.array(offer_ids.split(","), dtype=np.int64)
+    offers_indices = state.index(offers_ids)
+
+    # Offer with the best rpc sample
+    offer_id = int(offers_ids[select(state, offers_indices)[0]])
+
+    state.sample(click_id, offer_id)
+
+    # Prepare response
+    response = {
+        "click_id": click_id,
+        "offer_id": offer_id,
+    }
+
+    return response
+
+
+@app.post("/sample/batch")
+async def sample_batch(request: Request) -> list:
+    """Thompson sampling for many clicks with the same candidate offers
+
+    Body: {"click_ids": [click_id, ...], "offer_ids": [offer_id, ...]}
+    """
+    try:
+        body = await request.json()
+        # Floats would be silently truncated and bools taken for 0 and 1
+        if not all(type(item_id) is int for key in ("click_ids", "offer_ids") for item_id in body[key]):
+            raise ValueError("ids must be integers")
+        clicks_ids = np.array(body["click_ids"], dtype=np.int64)
+        offers_ids = np.array(body["offer_ids"], dtype=np.int64)
+    except (ValueError, TypeError, KeyError, OverflowError):
+        raise HTTPException(status_code=422, detail={"error": "invalid sample batch body"})
+
+    if clicks_ids.ndim != 1 or offers_ids.ndim != 1 or len(offers_ids) == 0:
+        raise HTTPException(status_code=422, detail={"error": "invalid sample batch body"})
+
+    offers_indices = state.index(offers_ids)
+    chosen = offers_ids[select(state, offers_indices, len(clicks_ids))]
+
+    state.sample_many(clicks_ids, chosen)
+
+    response = [
+        {"click_id": click_id, "offer_id": offer_id}
+        for click_id, offer_id in zip(clicks_ids.tolist(), chosen.tolist())
+    ]
+    return response
+
+
+@app.put("/feedback/")
+async def feedback(click_id: int, reward: float) -> dict:
+    """Get feedback for particular click"""
+    # Response body consists of click ID, offer ID, conversion status
+    # and whether the click already got feedback (then the reward is skipped)
+    return register_feedback(state, click_id, reward)
+
+
+@app.post("/feedback/batch")
+async def feedback_batch(request: Request) -> dict:
+    """Get feedback for many clicks, see feedback.register_feedback_batch"""
+    return await register_feedback_batch(state, request)
+
+
+@app.get("/offer_ids/{offer_id}/stats/")
+def stats(offer_id: int) -> dict:
+    """Return offer's statistics"""
+    response = state.stats(offer_id)
+    return response
+
+
+def main() -> None:
+    """Run application"""
+    uvicorn.run("thompson_sampling:app", host="localhost")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,62 @@
 import numpy as np
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 
+from bandit_state import BanditState
+from feedback import register_feedback, register_feedback_batch
+from shared_state import make_state
 
-app = FastAPI()
 
-# dictionary of offer_id: its count as value
-offers_count = {}
-# dictionary of click_id: its corresponding offer_id
-click_offer_dict = {}
-# dictionary of offer_id: number of its conversions
-offers_conversions = {}
-# dictionary of offer_id: sum of its rewards
-offers_rewards = {}
+app = FastAPI()
 
+# Per-offer counters and bounded click_id: offer_id table, shared by workers if
+# BANDIT_SHARED_STATE is set. Endpoints changing it are async, so it is only
+# updated from the event loop.
+state = make_state("upper_confidence_bound")
 
-def upper_confidence_bound(offer_id, step):
-    """Returns rpc (revenue per click) upper confidence bound for offer_id"""
-    rpc = stats(offer_id)['rpc']
 
-    if offer_id in offers_count:
-        ucb = rpc + np.sqrt(1.5 * np.log(step) / offers_count[offer_id])
-    else:
-        ucb = 1e300
+def upper_confidence_bound(state, offers_indices, step, c=1.5):
+    """Returns rpc (revenue per click) upper confidence bounds for offers indices"""
+    ucb = state.rpc[offers_indices] + np.sqrt(c * np.log(max(step, 1))) * state.inv_sqrt_clicks[offers_indices]
+    # Offers without clicks are sampled first
+    ucb[state.clicks[offers_indices] == 0] = 1e300
 
     return ucb
 
 
+def select(state: BanditState, offers_indices: np.ndarray, size: int = 1, c: float = 1.5) -> np.ndarray:
+    """UCB choice for the next size clicks, returns positions of chosen offers among candidates"""
+    step = state.total_clicks
+    return np.full(size, np.argmax(upper_confidence_bound(state, offers_indices, step, c)))
+
+
 @app.on_event("startup")
 def startup_event():
-    offers_count.clear()
-    click_offer_dict.clear()
-    offers_conversions.clear()
-    offers_rewards.clear()
+    # Shared state is initialized by the first worker, the others attach to it
+    if not state.shared:
+        state.clear()
+    # Restore state from the last snapshot and event log tail
+    if state.log is not None:
+        state.log.open(state)
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    if state.log is not None:
+        state.log.close()
 
 
 @app.get("/sample/")
-def sample(click_id: int, offer_ids: str) -> dict:
+async def sample(click_id: int, offer_ids: str) -> dict:
     """UCB sampling"""
     # Parse offer IDs
-    offers_ids = [int(offer) for offer in offer_ids.split(",")]
+    offers_ids = np.array(offer_ids.split(","), dtype=np.int64)
+    offers_indices = state.index(offers_ids)
 
     # Upper confidence bound sample offer ID
-    step = len(click_offer_dict)
-    offer_id = max(offers_ids, key=lambda x: upper_confidence_bound(x, step))
+    offer_id = int(offers_ids[select(state, offers_indices)[0]])
 
-    offers_count[offer_id] = offers_count.get(offer_id, 0) + 1
-    click_offer_dict[click_id] = offer_id
+    state.sample(click_id, offer_id)
 
     # Prepare response
     response = {
@@ -58,36 +68,23 @@ def sample(click_id: int, offer_ids: str) -> dict:
 
 
 @app.put("/feedback/")
-def feedback(click_id: int, reward: float) -> dict:
+async def feedback(click_id: int, reward: float) -> dict:
     """Get feedback for particular click"""
-    # Response body consists of click ID
-    # and accepted click status (True/False)
+    # Response body consists of click ID, offer ID, conversion status
+    # and whether the click already got feedback (then the reward is skipped)
+    return register_feedback(state, click_id, reward)
 
-    is_conversion = bool(reward)
-    offer_id = click_offer_dict[click_id]
-    offers_conversions[offer_id] = offers_conversions.get(offer_id, 0) + is_conversion
-    offers_rewards[offer_id] = offers_rewards.get(offer_id, 0) + reward
 
-    response = {
-        "click_id": click_id,
-        "offer_id": offer_id,
-        "is_conversion": is_conversion,
-        "reward": reward,
-    }
-    return response
+@app.post("/feedback/batch")
+async def feedback_batch(request: Request) -> dict:
+    """Get feedback for many clicks, see feedback.register_feedback_batch"""
+    return await register_feedback_batch(state, request)
 
 
 @app.get("/offer_ids/{offer_id}/stats/")
 def stats(offer_id: int) -> dict:
     """Return offer's statistics"""
-    response = {
-        "offer_id": offer_id,
-        "clicks": offers_count.get(offer_id, 0),
-        "conversions": offers_conversions.setdefault(offer_id, 0),
-        "reward": offers_rewards.setdefault(offer_id, 0),
-        "cr": offers_conversions[offer_id] / offers_count.get(offer_id, 1),
-        "rpc": offers_rewards[offer_id] / offers_count.get(offer_id, 1),
-    }
+    response = state.stats(offer_id)
     return response
 
 
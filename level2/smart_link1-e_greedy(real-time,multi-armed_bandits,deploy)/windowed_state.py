@@ -0,0 +1,252 @@
+"""Bandit state over recent data, for offers with drifting payouts."""
+from typing import Callable, Iterable, Optional
+
+import time
+import numpy as np
+
+from bandit_state import CLICKS_CAPACITY, CLICKS_TTL, BanditState
+
+
+class WindowedBanditState(BanditState):
+    """Counters of the last ``window`` seconds, in ring buckets.
+
+    Each offer has ``n_buckets`` buckets of ``window / n_buckets`` seconds
+    with sums of clicks, conversions and rewards, bucket ``b`` holds time
+    slot ``epoch`` with ``epoch % n_buckets == b``. An event resets the
+    bucket if it holds an older slot and adds to it, O(1). ``clicks``,
+    ``conversions``, ``rewards`` and the scores of offers are recomputed from
+    their buckets on every event and when they are looked up with
+    ``index``, so policies read the usual arrays.
+
+    Parameters
+    ----------
+    window: float :
+        window length in seconds
+    n_buckets: int :
+        number of buckets, window slides by window / n_buckets (Default value = 12)
+    clock: Callable[[], float] :
+        current time (Default value = time.time)
+    clicks_capacity: int :
+        maximum number of clicks kept for feedback (Default value = CLICKS_CAPACITY)
+    clicks_ttl: Optional[float] :
+        clicks retention in seconds (Default value = CLICKS_TTL)
+    offers_capacity: int :
+        initial size of counters arrays (Default value = 64)
+
+    """
+
+    def __init__(
+            self,
+            window: float,
+            n_buckets: int = 12,
+            clock: Callable[[], float] = time.time,
+            clicks_capacity: int = CLICKS_CAPACITY,
+            clicks_ttl: Optional[float] = CLICKS_TTL,
+            offers_capacity: int = 64,
+    ):
+        self.window = window
+        self.n_buckets = n_buckets
+        self.clock = clock
+        self.counters = BanditState.counters + (
+            ("bucket_epochs", np.int64, n_buckets),
+            # clicks, conversions and rewards of each bucket
+            ("bucket_sums", np.float64, 3 * n_buckets),
+        )
+        super().__init__(clicks_capacity, clicks_ttl, offers_capacity)
+
+    def _epoch(self) -> int:
+        return int(self.clock() * self.n_buckets // self.window)
+
+    def _epochs(self, times: np.ndarray) -> np.ndarray:
+        return (times * self.n_buckets // self.window).astype(np.int64)
+
+    def _add_one(self, idx: int, clicks: int, conversions: int, reward: float) -> None:
+        epoch = self._epoch()
+        bucket = epoch % self.n_buckets
+        sums = self.bucket_sums[idx].reshape(3, self.n_buckets)
+        if self.bucket_epochs[idx, bucket] != epoch:
+            self.bucket_epochs[idx, bucket] = epoch
+            sums[:, bucket] = 0
+        sums[:, bucket] += (clicks, conversions, reward)
+
+        valid = self.bucket_epochs[idx] > epoch - self.n_buckets
+        self.clicks[idx], self.conversions[idx], self.rewards[idx] = sums[:, valid].sum(axis=1)
+        self._update_scores(idx)
+
+    def _add(
+            self,
+            indices: np.ndarray,
+            clicks: int,
+            conversions: np.ndarray,
+            rewards: np.ndarray,
+            times: Optional[np.ndarray] = None,
+    ) -> None:
+        if times is None:
+            self._add_epoch(self._epoch(), indices, clicks, conversions, rewards)
+        else:
+            # Replayed events go to the buckets of their times, oldest first
+            epochs = self._epochs(times)
+            for epoch in np.unique(epochs).tolist():
+                at = epochs == epoch
+                self._add_epoch(epoch, indices[at], clicks, conversions[at], rewards[at])
+        self.refresh(np.unique(indices))
+
+    def _add_epoch(
+            self, epoch: int, indices: np.ndarray, clicks: int, conversions: np.ndarray, rewards: np.ndarray
+    ) -> None:
+        bucket = epoch % self.n_buckets
+        # Bucket already holding a later slot, the events are out of the window
+        current = self.bucket_epochs[indices, bucket] <= epoch
+        indices, conversions, rewards = indices[current], conversions[current], rewards[current]
+        unique = np.unique(indices)
+
+        stale = unique[self.bucket_epochs[unique, bucket] != epoch]
+        self.bucket_epochs[stale, bucket] = epoch
+        self.bucket_sums[stale[:, None], bucket + self.n_buckets * np.arange(3)] = 0
+
+        np.add.at(self.bucket_sums[:, bucket], indices, clicks)
+        np.add.at(self.bucket_sums[:, bucket + self.n_buckets], indices, conversions)
+        np.add.at(self.bucket_sums[:, bucket + 2 * self.n_buckets], indices, rewards)
+
+    def refresh(self, indices: np.ndarray) -> None:
+        """Recompute counters and scores of offers from their buckets of the current window."""
+        valid = self.bucket_epochs[indices] > self._epoch() - self.n_buckets
+        sums = self.bucket_sums[indices].reshape(len(indices), 3, self.n_buckets)
+        totals = np.einsum("ijk,ik->ji", sums, valid)
+        self.clicks[indices], self.conversions[indices], self.rewards[indices] = totals
+        self._update_scores(indices)
+
+    def index(self, offer_ids: Iterable[int]) -> np.ndarray:
+        """Return counters indices of offers, registering new ones, with counters of the current window."""
+        indices = super().index(offer_ids)
+        self.refresh(indices)
+        return indices
+
+    def _count_click(self, idx: int) -> None:
+        self._add_one(idx, 1, 0, 0.0)
+
+    def _add_clicks(self, indices: np.ndarray, times: Optional[np.ndarray] = None) -> None:
+        self._add(indices, 1, np.zeros(len(indices)), np.zeros(len(indices)), times)
+
+    def _count_reward(self, idx: int, reward: float) -> None:
+        self._add_one(idx, 0, reward != 0, reward)
+
+    def _count_rewards(self, indices: np.ndarray, rewards: np.ndarray, times: Optional[np.ndarray] = None) -> None:
+        self._add(indices, 0, rewards != 0, rewards, times)
+
+    def stats(self, offer_id: int) -> dict:
+        """Return offer's statistics over the window"""
+        idx = self._find(offer_id)
+        if idx >= 0:
+            self.refresh(np.array([idx]))
+        return super().stats(offer_id)
+
+
+class DiscountedBanditState(BanditState):
+    """Exponentially discounted counters, weight of an event halves every ``half_life`` seconds.
+
+    Each offer keeps discounted sums of clicks, conversions and rewards as of
+    its last event. An event decays them to the current time and adds to
+    them, O(1). Reads decay them again, so ``clicks``, ``conversions`` and
+    ``rewards`` are fractional, they are recomputed on every event and when
+    offers are looked up with ``index``.
+
+    Parameters
+    ----------
+    half_life: float :
+        half-life of events weight in seconds
+    clock: Callable[[], float] :
+        current time (Default value = time.time)
+    clicks_capacity: int :
+        maximum number of clicks kept for feedback (Default value = CLICKS_CAPACITY)
+    clicks_ttl: Optional[float] :
+        clicks retention in seconds (Default value = CLICKS_TTL)
+    offers_capacity: int :
+        initial size of counters arrays (Default value = 64)
+
+    """
+
+    counters = (
+        ("offer_ids", np.int64),
+        ("clicks", np.float64),
+        ("conversions", np.float64),
+        ("rewards", np.float64),
+        ("rpc", np.float64),
+        ("inv_sqrt_clicks", np.float64),
+        # Discounted clicks, conversions and rewards as of updated_at
+        ("updated_at", np.float64),
+        ("sums", np.float64, 3),
+    )
+
+    def __init__(
+            self,
+            half_life: float,
+            clock: Callable[[], float] = time.time,
+            clicks_capacity: int = CLICKS_CAPACITY,
+            clicks_ttl: Optional[float] = CLICKS_TTL,
+            offers_capacity: int = 64,
+    ):
+        self.half_life = half_life
+        self.clock = clock
+        super().__init__(clicks_capacity, clicks_ttl, offers_capacity)
+
+    def _add_one(self, idx: int, clicks: int, conversions: int, reward: float) -> None:
+        now = self.clock()
+        decay = 0.5 ** ((now - self.updated_at[idx]) / self.half_life)
+        self.sums[idx] = self.sums[idx] * decay + (clicks, conversions, reward)
+        self.updated_at[idx] = now
+
+        self.clicks[idx], self.conversions[idx], self.rewards[idx] = self.sums[idx]
+        self._update_scores(idx)
+
+    def _add(
+            self,
+            indices: np.ndarray,
+            clicks: int,
+            conversions: np.ndarray,
+            rewards: np.ndarray,
+            times: Optional[np.ndarray] = None,
+    ) -> None:
+        now = self.clock()
+        unique = np.unique(indices)
+        self.sums[unique] *= 0.5 ** ((now - self.updated_at[unique]) / self.half_life)[:, None]
+        self.updated_at[unique] = now
+
+        # Replayed events are decayed from their times to now
+        weights = 1.0 if times is None else 0.5 ** ((now - times) / self.half_life)
+        np.add.at(self.sums[:, 0], indices, clicks * weights)
+        np.add.at(self.sums[:, 1], indices, conversions * weights)
+        np.add.at(self.sums[:, 2], indices, rewards * weights)
+        self.refresh(unique)
+
+    def refresh(self, indices: np.ndarray) -> None:
+        """Recompute counters and scores of offers decayed to the current time."""
+        decay = 0.5 ** ((self.clock() - self.updated_at[indices]) / self.half_life)
+        totals = self.sums[indices].T * decay
+        self.clicks[indices], self.conversions[indices], self.rewards[indices] = totals
+        self._update_scores(indices)
+
+    def index(self, offer_ids: Iterable[int]) -> np.ndarray:
+        """Return counters indices of offers, registering new ones, with counters decayed to now."""
+        indices = super().index(offer_ids)
+        self.refresh(indices)
+        return indices
+
+    def _count_click(self, idx: int) -> None:
+        self._add_one(idx, 1, 0, 0.0)
+
+    def _add_clicks(self, indices: np.ndarray, times: Optional[np.ndarray] = None) -> None:
+        self._add(indices, 1, np.zeros(len(indices)), np.zeros(len(indices)), times)
+
+    def _count_reward(self, idx: int, reward: float) -> None:
+        self._add_one(idx, 0, reward != 0, reward)
+
+    def _count_rewards(self, indices: np.ndarray, rewards: np.ndarray, times: Optional[np.ndarray] = None) -> None:
+        self._add(indices, 0, rewards != 0, rewards, times)
+
+    def stats(self, offer_id: int) -> dict:
+        """Return offer's discounted statistics"""
+        idx = self._find(offer_id)
+        if idx >= 0:
+            self.refresh(np.array([idx]))
+        return super().stats(offer_id)
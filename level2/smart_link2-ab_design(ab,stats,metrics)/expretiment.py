@@ -2,6 +2,30 @@ from typing import Tuple, List
 import numpy as np
 
 
+_MASK64 = (1 << 64) - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def _fmix64(key: int) -> int:
+    """MurmurHash3 64-bit finalizer of a single key."""
+    key ^= key >> 33
+    key = (key * 0xFF51AFD7ED558CCD) & _MASK64
+    key ^= key >> 33
+    key = (key * 0xC4CEB9FE1A85EC53) & _MASK64
+    key ^= key >> 33
+    return key
+
+
+def _fmix64_many(keys: np.ndarray) -> np.ndarray:
+    """MurmurHash3 64-bit finalizer of an uint64 array, same as _fmix64."""
+    keys = keys ^ (keys >> np.uint64(33))
+    keys *= np.uint64(0xFF51AFD7ED558CCD)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xC4CEB9FE1A85EC53)
+    keys ^= keys >> np.uint64(33)
+    return keys
+
+
 class Experiment:
     """Experiment class. Contains the logic for assigning users to groups."""
 
@@ -17,18 +41,28 @@ class Experiment:
 
         # Define the salt for experiment_id.
         # The salt should be deterministic and unique for each experiment_id.
-        self.salt = str(self.experiment_id)
+        self.salt = _fmix64((experiment_id + _GOLDEN) & _MASK64)
 
         # Define the group weights if they are not provided equaly distributed
         # Check input group weights. They must be non-negative and sum to 1.
 
         if self.group_weights:
-            if sum(self.group_weights) != 1 and np.all(np.array(self.group_weights) >= 0):
+            weights = np.array(self.group_weights, dtype=np.float64)
+            if not np.isclose(weights.sum(), 1) or np.any(weights < 0):
                 raise NotImplementedError("Group weights must be non-negative and sum to 1!")
         else:
             group_count = len(self.groups)
             self.group_weights = [1 / group_count for _ in range(group_count)]
 
+        # Right boundaries of groups in [0, 1), the last one is exactly 1
+        self.boundaries = np.cumsum(self.group_weights)
+        self.boundaries[-1] = 1.0
+        self._boundaries = self.boundaries.tolist()
+
+    def _uniform(self, click_id: int) -> float:
+        """Deterministic uniform [0, 1) value of the click, same on every node and run."""
+        return (_fmix64((click_id & _MASK64) ^ self.salt) >> 11) * 2.0 ** -53
+
     def group(self, click_id: int) -> Tuple[int, str]:
         """Assigns a click to a group.
 
@@ -46,8 +80,26 @@ class Experiment:
         # Assign the click to a group randomly based on the group weights
         # Return the group id and group name
 
-        acc = max(map(lambda x: len(str(x)) - 2, self.group_weights))
-        remainder = hash(str(click_id) + self.salt) % 10**acc / 10**acc
-        group_id = np.searchsorted(np.cumsum(self.group_weights), remainder, side='right')
+        remainder = self._uniform(click_id)
+        group_id = next(i for i, boundary in enumerate(self._boundaries) if remainder < boundary)
 
         return group_id, self.groups[group_id]
+
+    def group_many(self, click_ids: np.ndarray) -> np.ndarray:
+        """Assigns clicks to groups, same as group() for each click.
+
+        Parameters
+        ----------
+        click_ids: np.ndarray :
+            ids of the clicks
+
+        Returns
+        -------
+        np.ndarray :
+            group ids, names are np.asarray(self.groups)[group_ids]
+        """
+        keys = np.asarray(click_ids).astype(np.int64).view(np.uint64)
+        hashed = _fmix64_many(keys ^ np.uint64(self.salt))
+        remainders = (hashed >> np.uint64(11)) * 2.0 ** -53
+
+        return np.searchsorted(self.boundaries, remainders, side='right')
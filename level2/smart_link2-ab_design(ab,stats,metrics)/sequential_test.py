@@ -0,0 +1,124 @@
+from typing import Tuple
+import numpy as np
+
+
+class SequentialTest:
+    """Always-valid test of cpc of groups against the control group (mixture SPRT).
+
+    Each group keeps three sums: clicks, rewards and squared rewards, so
+    events are counted in O(1) and a click can get its reward later. The
+    cpc of a click is its reward, or 0 without conversion.
+
+    For the difference of group and control cpc means D with estimated
+    variance V = var_g / n_g + var_c / n_c and a N(0, tau^2) mixture over
+    the true difference, the likelihood ratio against "no difference" is
+    sqrt(V / (V + tau^2)) * exp(D^2 tau^2 / (2 V (V + tau^2))). Its inverse,
+    minimized over all looks, is a p-value valid at any time (Johari et al.,
+    Always Valid Inference), so results can be checked after every event
+    and the experiment stopped as soon as p_values() <= alpha.
+
+    Parameters
+    ----------
+    groups: Tuple[str] :
+        group names, the first one is control, as in Experiment (Default value = ("A", "B"))
+    tau: float :
+        standard deviation of the mixture, about the expected absolute effect on cpc (Default value = 1.0)
+    alpha: float :
+        significance level (Default value = 0.05)
+    min_clicks: int :
+        clicks of a group before its variance is trusted (Default value = 100)
+
+    """
+
+    def __init__(
+            self,
+            groups: Tuple[str] = ("A", "B"),
+            tau: float = 1.0,
+            alpha: float = 0.05,
+            min_clicks: int = 100,
+    ):
+        self.groups = groups
+        self.tau = tau
+        self.alpha = alpha
+        self.min_clicks = min_clicks
+
+        self.clicks = np.zeros(len(groups))
+        self.rewards = np.zeros(len(groups))
+        self.squares = np.zeros(len(groups))
+        # Running minimum of p-values over the looks
+        self._p_values = np.ones(len(groups))
+
+    def click(self, group_id: int, n: int = 1) -> None:
+        """Count n clicks of the group, without rewards yet."""
+        self.clicks[group_id] += n
+
+    def reward(self, group_id: int, reward: float) -> None:
+        """Count reward of an already counted click of the group."""
+        self.rewards[group_id] += reward
+        self.squares[group_id] += reward ** 2
+
+    def observe(self, group_ids: np.ndarray, cpc: np.ndarray) -> None:
+        """Count clicks with their cpc, e.g. a batch of events.
+
+        Parameters
+        ----------
+        group_ids: np.ndarray :
+            group of each click, e.g. from Experiment.group_many
+        cpc: np.ndarray :
+            cpc of each click
+
+        """
+        n_groups = len(self.groups)
+        cpc = np.asarray(cpc, dtype=np.float64)
+        self.clicks += np.bincount(group_ids, minlength=n_groups)
+        self.rewards += np.bincount(group_ids, cpc, minlength=n_groups)
+        self.squares += np.bincount(group_ids, cpc ** 2, minlength=n_groups)
+
+    def _moments(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Difference of cpc means with control and its variance, NaN for groups without enough clicks."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.rewards / self.clicks
+            var = (self.squares - self.rewards * mean) / (self.clicks - 1)
+            enough = self.clicks >= max(self.min_clicks, 2)
+            mean_var = np.where(enough, np.maximum(var, 0) / self.clicks, np.nan)
+
+        diff = mean - mean[0]
+        diff_var = mean_var + mean_var[0]
+        diff_var[0] = np.nan
+        return diff, diff_var
+
+    def p_values(self) -> np.ndarray:
+        """Always-valid p-values of the difference of each group with control, 1 for control."""
+        diff, diff_var = self._moments()
+        tau2 = self.tau ** 2
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            # Logarithm of the mixture likelihood ratio
+            log_ratio = 0.5 * np.log(diff_var / (diff_var + tau2)) + diff ** 2 * tau2 / (
+                2 * diff_var * (diff_var + tau2)
+            )
+            p_values = np.minimum(1, np.exp(-log_ratio))
+
+        valid = np.isfinite(log_ratio) & (diff_var > 0)
+        self._p_values[valid] = np.minimum(self._p_values[valid], p_values[valid])
+        return self._p_values.copy()
+
+    def confidence_intervals(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Always-valid 1 - alpha confidence intervals of the difference of each group with control.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray] :
+            lower and upper bounds, infinite without enough clicks
+        """
+        diff, diff_var = self._moments()
+        tau2 = self.tau ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            half_width = np.sqrt(
+                diff_var * (diff_var + tau2) / tau2 * (np.log((diff_var + tau2) / diff_var) - 2 * np.log(self.alpha))
+            )
+        known = np.isfinite(diff) & np.isfinite(half_width)
+        return np.where(known, diff - half_width, -np.inf), np.where(known, diff + half_width, np.inf)
+
+    def significant(self) -> np.ndarray:
+        """True for groups whose difference with control is significant, the experiment can be stopped."""
+        return self.p_values() <= self.alpha
@@ -1,5 +1,10 @@
 from math import ceil, sqrt
-from scipy import stats
+from typing import Union
+import numpy as np
+from scipy import special, stats
+
+
+ArrayLike = Union[float, np.ndarray]
 
 
 def calculate_sample_size(
@@ -63,3 +68,98 @@ def calculate_mde(
     mde = sum(stats.norm.ppf([1 - alpha / 2, 1 - beta])) * reward_std * sqrt(2 / sample_size)
 
     return mde
+
+
+def cuped_std(reward_std: ArrayLike, correlation: ArrayLike) -> np.ndarray:
+    """Standard deviation of reward adjusted by CUPED.
+
+    CUPED subtracts theta * (covariate - its mean) from reward, which
+    leaves variance reward_std^2 * (1 - correlation^2) with the optimal
+    theta, correlation is of reward with the pre-experiment covariate.
+    """
+    return np.asarray(reward_std) * np.sqrt(1 - np.asarray(correlation) ** 2)
+
+
+def _z_sum(alpha: ArrayLike, beta: ArrayLike) -> np.ndarray:
+    """Sum of normal quantiles of 1 - alpha / 2 and 1 - beta."""
+    return -special.ndtri(np.asarray(alpha) / 2) - special.ndtri(np.asarray(beta))
+
+
+def calculate_sample_size_grid(
+        reward_avg: ArrayLike,
+        reward_std: ArrayLike,
+        mde: ArrayLike,
+        alpha: ArrayLike,
+        beta: ArrayLike,
+        correlation: ArrayLike = 0.0,
+) -> np.ndarray:
+    """Calculate sample sizes for all combinations of parameters at once.
+
+    Same as calculate_sample_size, arguments are broadcast against each
+    other, e.g. mde[:, None] and beta[None, :] give a (len(mde), len(beta))
+    grid.
+
+    Parameters
+    ----------
+    reward_avg: ArrayLike :
+        average reward
+    reward_std: ArrayLike :
+        standard deviation of reward
+    mde: ArrayLike :
+        minimum detectable effect
+    alpha: ArrayLike :
+        significance level
+    beta: ArrayLike :
+        type 2 error probability
+    correlation: ArrayLike :
+        correlation of reward with the CUPED covariate, 0 without CUPED (Default value = 0.0)
+
+    Returns
+    -------
+    np.ndarray :
+        sample sizes
+
+    """
+    assert np.all(np.asarray(mde) > 0), "mde should be greater than 0"
+
+    std = cuped_std(reward_std, correlation)
+    sample_size = np.ceil(2 * (_z_sum(alpha, beta) * std / mde / reward_avg) ** 2)
+
+    return sample_size.astype(np.int64)
+
+
+def calculate_mde_grid(
+        reward_std: ArrayLike,
+        sample_size: ArrayLike,
+        alpha: ArrayLike,
+        beta: ArrayLike,
+        correlation: ArrayLike = 0.0,
+) -> np.ndarray:
+    """Calculate minimal detectable effects for all combinations of parameters at once.
+
+    Same as calculate_mde, arguments are broadcast against each other, see
+    calculate_sample_size_grid.
+
+    Parameters
+    ----------
+    reward_std: ArrayLike :
+        standard deviation of reward
+    sample_size: ArrayLike :
+        sample size
+    alpha: ArrayLike :
+        significance level
+    beta: ArrayLike :
+        type 2 error probability
+    correlation: ArrayLike :
+        correlation of reward with the CUPED covariate, 0 without CUPED (Default value = 0.0)
+
+    Returns
+    -------
+    np.ndarray :
+        minimal detectable effects
+
+    """
+    std = cuped_std(reward_std, correlation)
+    mde = _z_sum(alpha, beta) * std * np.sqrt(2 / np.asarray(sample_size))
+
+    return mde
@@ -1,19 +1,151 @@
-from typing import List, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from math import sqrt
+from typing import Callable, Iterator, List, Optional, Tuple
+import os
 import numpy as np
 from scipy import stats
 
+from smaple_size_and_mde_calc import calculate_mde, calculate_sample_size
+
 
 def cpc_sample(
-    n_samples: int, conversion_rate: float, reward_avg: float, reward_std: float
+    n_samples: int,
+    conversion_rate: float,
+    reward_avg: float,
+    reward_std: float,
+    rng: Optional[np.random.Generator] = None,
 ) -> np.ndarray:
-    """Sample data."""
-    cvr = np.random.binomial(1, conversion_rate, n_samples)
-    cpa = np.random.normal(reward_avg, reward_std, n_samples)
+    """Sample data, rng is a random generator, None for global np.random state."""
+    rng = np.random if rng is None else rng
+    cvr = rng.binomial(1, conversion_rate, n_samples)
+    cpa = rng.normal(reward_avg, reward_std, n_samples)
     cpc = cvr * cpa
 
     return cpc
 
 
+def cpc_sample_moments(
+    n_simulations: int,
+    n_samples: int,
+    conversion_rate: float,
+    reward_avg: float,
+    reward_std: float,
+    rng: Optional[np.random.Generator] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample means and variances (ddof=1) of n_simulations cpc samples, without drawing the samples.
+
+    A cpc sample is K ~ Binomial(n_samples, conversion_rate) normal rewards
+    and zeros. Mean of the K rewards is N(reward_avg, reward_std^2 / K) and,
+    independently of it, their sum of squared deviations is
+    reward_std^2 * chi2(K - 1), so moments have exactly the distribution of
+    moments of cpc_sample(), in O(n_simulations).
+
+    Parameters
+    ----------
+    n_simulations: int :
+        number of samples
+    n_samples: int :
+        size of each sample
+    conversion_rate: float :
+        conversion rate
+    reward_avg: float :
+        average reward of a conversion
+    reward_std: float :
+        standard deviation of reward of a conversion
+    rng: Optional[np.random.Generator] :
+        random generator, None for global np.random state (Default value = None)
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray] :
+        means and variances of the samples
+    """
+    rng = np.random if rng is None else rng
+    conversions = rng.binomial(n_samples, conversion_rate, n_simulations)
+    rewards_mean = rng.normal(reward_avg, reward_std / np.sqrt(np.maximum(conversions, 1)))
+    # chi2(k) is 2 * Gamma(k / 2), shape 0 gives 0 for samples with less than two conversions
+    rewards_ss = reward_std ** 2 * 2 * rng.gamma(np.maximum(conversions - 1, 0) / 2)
+
+    mean = conversions * rewards_mean / n_samples
+    # Squared deviations from the mean: of rewards, of rewards mean, and of zeros
+    squares = rewards_ss + conversions * (rewards_mean - mean) ** 2 + (n_samples - conversions) * mean ** 2
+    var = squares / (n_samples - 1)
+
+    return mean, var
+
+
+def t_test_many(
+    mean_a: np.ndarray,
+    var_a: np.ndarray,
+    n_a: int,
+    mean_b: np.ndarray,
+    var_b: np.ndarray,
+    n_b: int,
+    equal_var: bool = True,
+) -> np.ndarray:
+    """Two-sided t-test p-values for many pairs of samples given their moments.
+
+    Parameters
+    ----------
+    mean_a: np.ndarray :
+        means of first samples
+    var_a: np.ndarray :
+        variances (ddof=1) of first samples
+    n_a: int :
+        size of first samples
+    mean_b: np.ndarray :
+        means of second samples
+    var_b: np.ndarray :
+        variances (ddof=1) of second samples
+    n_b: int :
+        size of second samples
+    equal_var: bool :
+        Student's t-test if True, Welch's t-test otherwise, as in stats.ttest_ind (Default value = True)
+
+    Returns
+    -------
+    np.ndarray :
+        p-values, NaN for samples without variance
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if equal_var:
+            df = n_a + n_b - 2
+            pooled_var = ((n_a - 1) * var_a + (n_b - 1) * var_b) / df
+            se = np.sqrt(pooled_var * (1 / n_a + 1 / n_b))
+        else:
+            se_a, se_b = var_a / n_a, var_b / n_b
+            se = np.sqrt(se_a + se_b)
+            df = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+
+        t_stat = (mean_a - mean_b) / se
+
+    return 2 * stats.t.sf(np.abs(t_stat), df)
+
+
+def simulate_p_values(
+    n_simulations: int,
+    n_samples: int,
+    cvr_a: float,
+    cvr_b: float,
+    reward_avg: float,
+    reward_std: float,
+    equal_var: bool = True,
+    chunk_size: int = 1_000_000,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """t-test p-values of n_simulations pairs of cpc samples, in chunks of chunk_size simulations."""
+    p_values = np.empty(n_simulations)
+    for start in range(0, n_simulations, chunk_size):
+        size = min(chunk_size, n_simulations - start)
+        mean_a, var_a = cpc_sample_moments(size, n_samples, cvr_a, reward_avg, reward_std, rng)
+        mean_b, var_b = cpc_sample_moments(size, n_samples, cvr_b, reward_avg, reward_std, rng)
+        p_values[start:start + size] = t_test_many(mean_a, var_a, n_samples, mean_b, var_b, n_samples, equal_var)
+
+    return p_values
+
+
 def t_test(cpc_a: np.ndarray, cpc_b: np.ndarray, alpha=0.05) -> Tuple[bool, float]:
     """Perform t-test.
 
@@ -37,6 +169,146 @@ def t_test(cpc_a: np.ndarray, cpc_b: np.ndarray, alpha=0.05) -> Tuple[bool, floa
     return p_value <= alpha, p_value
 
 
+# Simulations per block of the engines, a block is the unit of work of a worker process
+BLOCK_SIZES = {"vectorized": 100_000, "loop": 1_000}
+
+
+@contextmanager
+def process_pool(n_jobs: int = 1) -> Iterator[Optional[Executor]]:
+    """Pool of n_jobs worker processes, -1 for one per CPU, None for n_jobs=1 (run in this process)."""
+    if n_jobs == 1:
+        yield None
+        return
+    with ProcessPoolExecutor(os.cpu_count() if n_jobs == -1 else n_jobs) as executor:
+        yield executor
+
+
+def simulation_blocks(
+        n_simulations: int, seed: Optional[int] = None, block_size: int = 100_000
+) -> List[Tuple[int, np.random.SeedSequence]]:
+    """Split simulations into blocks of block_size with independent seeds spawned from seed.
+
+    Block i always gets the i-th spawned seed, so the result of simulations
+    doesn't depend on how blocks are distributed between processes.
+
+    Parameters
+    ----------
+    n_simulations: int :
+        number of simulations
+    seed: Optional[int] :
+        root seed, None for fresh entropy (Default value = None)
+    block_size: int :
+        simulations per block (Default value = 100_000)
+
+    Returns
+    -------
+    List[Tuple[int, np.random.SeedSequence]] :
+        number of simulations and seed of each block
+    """
+    sizes = [min(block_size, n_simulations - start) for start in range(0, n_simulations, block_size)]
+    return list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+
+
+def _count_block(
+        block: Tuple[int, np.random.SeedSequence],
+        n_samples: int,
+        cvr_a: float,
+        cvr_b: float,
+        reward_avg: float,
+        reward_std: float,
+        alpha: float,
+        engine: str,
+) -> int:
+    """Number of simulations of the block where the t-test rejects equality of A and B."""
+    size, seed = block
+    rng = np.random.default_rng(seed)
+    if engine == "vectorized":
+        p_values = simulate_p_values(size, n_samples, cvr_a, cvr_b, reward_avg, reward_std, rng=rng)
+        return int((p_values <= alpha).sum())
+
+    rejections = 0
+    for _ in range(size):
+        # Generate cpc samples of A and B, check t-test
+        cpc_a = cpc_sample(n_samples, cvr_a, reward_avg, reward_std, rng)
+        cpc_b = cpc_sample(n_samples, cvr_b, reward_avg, reward_std, rng)
+        rejections += t_test(cpc_a, cpc_b, alpha)[0]
+
+    return rejections
+
+
+def block_rejections(
+        n_simulations: int,
+        n_samples: int,
+        cvr_a: float,
+        cvr_b: float,
+        reward_avg: float,
+        reward_std: float,
+        alpha: float = 0.05,
+        engine: str = "vectorized",
+        seed: Optional[int] = None,
+        executor: Optional[Executor] = None,
+        block_size: Optional[int] = None,
+) -> Iterator[Tuple[int, int]]:
+    """Simulate t-tests of cpc samples of A and B in blocks (see simulation_blocks).
+
+    Blocks are computed by executor workers if it is given, in this process
+    otherwise. Results are yielded in order of blocks, so they are the same
+    for any number of workers.
+
+    Parameters
+    ----------
+    n_simulations: int :
+        number of simulations
+    n_samples: int :
+        size of each sample
+    cvr_a: float :
+        conversion rate of A
+    cvr_b: float :
+        conversion rate of B
+    reward_avg: float :
+        average reward of a conversion
+    reward_std: float :
+        standard deviation of reward of a conversion
+    alpha: float :
+        significance level (Default value = 0.05)
+    engine: str :
+        "vectorized" or "loop", see aa_test (Default value = "vectorized")
+    seed: Optional[int] :
+        root seed of blocks, None for fresh entropy (Default value = None)
+    executor: Optional[Executor] :
+        workers pool, see process_pool (Default value = None)
+    block_size: Optional[int] :
+        simulations per block, None for BLOCK_SIZES of the engine (Default value = None)
+
+    Returns
+    -------
+    Iterator[Tuple[int, int]] :
+        number of simulations and of rejected equality of A and B of each block
+    """
+    if engine not in BLOCK_SIZES:
+        raise NotImplementedError("Only vectorized and loop engines currently supported!")
+
+    blocks = simulation_blocks(n_simulations, seed, block_size or BLOCK_SIZES[engine])
+    task = partial(
+        _count_block,
+        n_samples=n_samples,
+        cvr_a=cvr_a,
+        cvr_b=cvr_b,
+        reward_avg=reward_avg,
+        reward_std=reward_std,
+        alpha=alpha,
+        engine=engine,
+    )
+    rejections = map(task, blocks) if executor is None else executor.map(task, blocks)
+
+    return zip((size for size, _ in blocks), rejections)
+
+
+def count_rejections(*args, **kwargs) -> int:
+    """Number of simulations with rejected equality of A and B, arguments of block_rejections."""
+    return sum(rejected for _, rejected in block_rejections(*args, **kwargs))
+
+
 def aa_test(
         n_simulations: int,
         n_samples: int,
@@ -44,19 +316,24 @@ def aa_test(
         reward_avg: float,
         reward_std: float,
         alpha: float = 0.05,
+        engine: str = "vectorized",
+        n_jobs: int = 1,
+        seed: Optional[int] = None,
 ) -> float:
-    """Do the A/A test (simulation)."""
+    """Do the A/A test (simulation).
 
-    type_1_errors = np.zeros(n_simulations)
-    for i in range(n_simulations):
-        # Generate two cpc samples with the same cvr, reward_avg, and reward_std
-        # Check t-test and save type 1 error
-        cpc1 = cpc_sample(n_samples, cvr, reward_avg, reward_std)
-        cpc2 = cpc_sample(n_samples, cvr, reward_avg, reward_std)
-        type_1_errors[i] = t_test(cpc1, cpc2, alpha)[0]
+    engine is "vectorized" (all simulations at once, see simulate_p_values)
+    or "loop" (a t-test on drawn samples per simulation). Simulations run in
+    blocks on n_jobs processes (-1 for all CPUs), the result for a given
+    seed doesn't depend on n_jobs, see block_rejections.
+    """
+    with process_pool(n_jobs) as executor:
+        type_1_errors = count_rejections(
+            n_simulations, n_samples, cvr, cvr, reward_avg, reward_std, alpha, engine, seed, executor
+        )
 
     # Calculate the type 1 errors rate
-    type_1_errors_rate = type_1_errors.mean()
+    type_1_errors_rate = type_1_errors / n_simulations
 
     return type_1_errors_rate
 
@@ -69,24 +346,133 @@ def ab_test(
     reward_avg: float,
     reward_std: float,
     alpha: float = 0.05,
+    engine: str = "vectorized",
+    n_jobs: int = 1,
+    seed: Optional[int] = None,
 ) -> float:
-    """Do the A/B test (simulation)."""
+    """Do the A/B test (simulation).
 
-    type_2_errors = np.zeros(n_simulations)
-    for i in range(n_simulations):
-        # Generate one cpc sample with the given conversion_rate, reward_avg, and reward_std
-        # Generate another cpc sample with the given conversion_rate * mde, reward_avg, and reward_std
-        # Check t-test and save type 2 error
-        cpc1 = cpc_sample(n_samples, cvr, reward_avg, reward_std)
-        cpc2 = cpc_sample(n_samples, cvr * (1 + mde), reward_avg, reward_std)
-        type_2_errors[i] = not t_test(cpc1, cpc2, alpha)[0]
+    engine is "vectorized" (all simulations at once, see simulate_p_values)
+    or "loop" (a t-test on drawn samples per simulation). Simulations run in
+    blocks on n_jobs processes (-1 for all CPUs), the result for a given
+    seed doesn't depend on n_jobs, see block_rejections.
+    """
+    with process_pool(n_jobs) as executor:
+        type_2_errors = n_simulations - count_rejections(
+            n_simulations, n_samples, cvr, cvr * (1 + mde), reward_avg, reward_std, alpha, engine, seed, executor
+        )
 
     # Calculate the type 2 errors rate
-    type_2_errors_rate = type_2_errors.mean()
+    type_2_errors_rate = type_2_errors / n_simulations
 
     return type_2_errors_rate
 
 
+def cpc_moments(cvr: float, reward_avg: float, reward_std: float) -> Tuple[float, float]:
+    """Mean and standard deviation of cpc of a click."""
+    mean = cvr * reward_avg
+    std = sqrt(cvr * (reward_std ** 2 + reward_avg ** 2) - mean ** 2)
+    return mean, std
+
+
+def error_rate_bound(
+        n_simulations: int,
+        n_samples: int,
+        cvr_a: float,
+        cvr_b: float,
+        reward_avg: float,
+        reward_std: float,
+        alpha: float,
+        bound: float,
+        type_2: bool,
+        seed: int = 0,
+        n_batches: int = 10,
+        z: float = 2.58,
+        engine: str = "vectorized",
+        executor: Optional[Executor] = None,
+) -> Tuple[float, bool]:
+    """Estimate type 1 (or type 2) error rate and check it against bound.
+
+    Simulations run in n_batches blocks, and stop as soon as the normal
+    confidence interval (z standard errors) of the rate lies on one side of
+    bound. Blocks are seeded from seed, so calls for different sample sizes
+    or MDEs share common random numbers. With executor, workers compute
+    next blocks ahead and the ones not needed are cancelled.
+
+    Returns
+    -------
+    Tuple[float, bool] :
+        estimated error rate
+        True if it doesn't exceed bound
+    """
+    batches = block_rejections(
+        n_simulations, n_samples, cvr_a, cvr_b, reward_avg, reward_std, alpha, engine, seed, executor,
+        -(-n_simulations // n_batches),
+    )
+    errors, done = 0, 0
+    for size, rejected in batches:
+        errors += size - rejected if type_2 else rejected
+        done += size
+
+        rate = errors / done
+        half_width = z * sqrt(max(rate * (1 - rate), 1 / done) / done)
+        if rate + half_width < bound or rate - half_width > bound:
+            break
+
+    return rate, rate <= bound
+
+
+def first_passing(n_points: int, start: int, passes: Callable[[int], bool]) -> Optional[int]:
+    """Smallest index in range(n_points) for which monotone passes() is True, None if there is none.
+
+    The bracket is found by doubling steps from start, then it is bisected.
+    """
+    start = min(max(start, 0), n_points - 1)
+    if passes(start):
+        passing, failing, step = start, start - 1, 1
+        while failing >= 0 and passes(failing):
+            passing, step = failing, step * 2
+            failing = passing - step
+        failing = max(failing, -1)
+    else:
+        failing, passing, step = start, start + 1, 1
+        while passing < n_points and not passes(passing):
+            failing, passing, step = passing, passing + step, step * 2
+        if passing >= n_points:
+            passing = n_points - 1
+            if not passes(passing):
+                return None
+
+    # passes(failing) is False (or failing is -1), passes(passing) is True
+    while passing - failing > 1:
+        middle = (failing + passing) // 2
+        if passes(middle):
+            passing = middle
+        else:
+            failing = middle
+
+    return passing
+
+
+def lowest_candidate(
+        n_points: int, first: int, error: Callable[[int], float], bound: float, n_simulations: int, z: float = 2.58
+) -> int:
+    """Index from which grid points are checked on full simulations, after the early stopped search found first.
+
+    Error rates estimated on full simulations aren't exactly monotone over
+    the grid, so the grid method may stop at a point below first where the
+    error dips below bound. The index steps up while error exceeds bound,
+    then down while the smaller point's error is within z standard errors
+    of bound (points further above bound practically never pass).
+    """
+    while first < n_points - 1 and error(first) > bound:
+        first += 1
+    band = z * sqrt(bound * (1 - bound) / n_simulations)
+    while first > 0 and error(first - 1) <= bound + band:
+        first -= 1
+    return first
+
+
 def select_sample_size(
         n_samples_grid: List[int],
         n_simulations: int,
@@ -96,14 +482,40 @@ def select_sample_size(
         reward_std: float,
         alpha: float = 0.05,
         beta: float = 0.2,
+        engine: str = "vectorized",
+        method: str = "grid",
+        seed: int = 0,
+        n_jobs: int = 1,
 ) -> Tuple[int, float, float]:
-    """Select sample size."""
-    for n_samples in n_samples_grid:
-        # Implement your solution here
-        type_1_error = aa_test(n_simulations, n_samples, cvr, reward_avg, reward_std, alpha)
-        type_2_error = ab_test(n_simulations, n_samples, cvr, mde, reward_avg, reward_std, alpha)
-        if type_1_error <= alpha and type_2_error <= beta:
-            return n_samples, type_1_error, type_2_error
+    """Select sample size.
+
+    method "grid" checks sample sizes of the grid one by one. "search"
+    starts from the analytic calculate_sample_size(), binary searches the
+    sorted grid for the smallest size with type 2 error below beta (power
+    grows with sample size), with early stopping (see error_rate_bound),
+    then checks type 1 error from there. Simulations of all sample sizes
+    are seeded from seed (common random numbers) and run on n_jobs
+    processes, see aa_test.
+    """
+    if method not in ("grid", "search"):
+        raise NotImplementedError("Only grid and search methods currently supported!")
+
+    with process_pool(n_jobs) as executor:
+        if method == "search":
+            return search_sample_size(
+                n_samples_grid, n_simulations, cvr, mde, reward_avg, reward_std, alpha, beta,
+                seed=seed, engine=engine, executor=executor,
+            )
+
+        for n_samples in n_samples_grid:
+            type_1_error = count_rejections(
+                n_simulations, n_samples, cvr, cvr, reward_avg, reward_std, alpha, engine, seed, executor
+            ) / n_simulations
+            type_2_error = (n_simulations - count_rejections(
+                n_simulations, n_samples, cvr, cvr * (1 + mde), reward_avg, reward_std, alpha, engine, seed, executor
+            )) / n_simulations
+            if type_1_error <= alpha and type_2_error <= beta:
+                return n_samples, type_1_error, type_2_error
 
     raise RuntimeError(
         "Can't find sample size. "
@@ -123,13 +535,33 @@ def select_mde(
         reward_std: float,
         alpha: float = 0.05,
         beta: float = 0.2,
+        engine: str = "vectorized",
+        method: str = "grid",
+        seed: int = 0,
+        n_jobs: int = 1,
 ) -> Tuple[float, float]:
-    """Select MDE."""
-    for mde in mde_grid:
-        # Implement your solution here
-        type_2_error = ab_test(n_simulations, n_samples, cvr, mde, reward_avg, reward_std, alpha)
-        if type_2_error <= beta:
-            return mde, type_2_error
+    """Select MDE.
+
+    method "grid" checks MDEs of the grid one by one. "search" starts from
+    the analytic calculate_mde() and binary searches the sorted grid for the
+    smallest MDE with type 2 error below beta, see select_sample_size.
+    """
+    if method not in ("grid", "search"):
+        raise NotImplementedError("Only grid and search methods currently supported!")
+
+    with process_pool(n_jobs) as executor:
+        if method == "search":
+            return search_mde(
+                n_samples, n_simulations, cvr, mde_grid, reward_avg, reward_std, alpha, beta,
+                seed=seed, engine=engine, executor=executor,
+            )
+
+        for mde in mde_grid:
+            type_2_error = (n_simulations - count_rejections(
+                n_simulations, n_samples, cvr, cvr * (1 + mde), reward_avg, reward_std, alpha, engine, seed, executor
+            )) / n_simulations
+            if type_2_error <= beta:
+                return mde, type_2_error
 
     raise RuntimeError(
         "Can't find MDE. "
@@ -137,3 +569,105 @@ def select_mde(
         f"last type 2 error: {type_2_error}. "
         "Make sure that the grid is big enough."
     )
+
+
+def search_sample_size(
+        n_samples_grid: List[int],
+        n_simulations: int,
+        cvr: float,
+        mde: float,
+        reward_avg: float,
+        reward_std: float,
+        alpha: float = 0.05,
+        beta: float = 0.2,
+        seed: int = 0,
+        engine: str = "vectorized",
+        executor: Optional[Executor] = None,
+) -> Tuple[int, float, float]:
+    """Select sample size with binary search, see select_sample_size."""
+    grid = sorted(n_samples_grid)
+    cpc_avg, cpc_std = cpc_moments(cvr, reward_avg, reward_std)
+    start = int(np.searchsorted(grid, calculate_sample_size(cpc_avg, cpc_std, mde, alpha, beta)))
+
+    def powerful(i: int) -> bool:
+        return error_rate_bound(
+            n_simulations, grid[i], cvr, cvr * (1 + mde), reward_avg, reward_std, alpha, beta, True, seed,
+            engine=engine, executor=executor,
+        )[1]
+
+    def type_1_error(i: int) -> float:
+        return count_rejections(
+            n_simulations, grid[i], cvr, cvr, reward_avg, reward_std, alpha, engine, seed, executor
+        ) / n_simulations
+
+    def type_2_error(i: int) -> float:
+        if i not in type_2_errors:
+            type_2_errors[i] = (n_simulations - count_rejections(
+                n_simulations, grid[i], cvr, cvr * (1 + mde), reward_avg, reward_std, alpha, engine, seed, executor
+            )) / n_simulations
+        return type_2_errors[i]
+
+    type_2_errors = {}
+    first = first_passing(len(grid), start, powerful)
+    if first is not None:
+        # Early stopping may be wrong near beta, grid points from the found one
+        # are checked on full simulations, the first one passing both checks is taken as in grid method
+        for i in range(lowest_candidate(len(grid), first, type_2_error, beta, n_simulations), len(grid)):
+            if type_2_error(i) <= beta:
+                error = type_1_error(i)
+                if error <= alpha:
+                    return grid[i], error, type_2_error(i)
+
+    raise RuntimeError(
+        "Can't find sample size. "
+        f"Largest sample size: {grid[-1]}. "
+        "Make sure that the grid is big enough."
+    )
+
+
+def search_mde(
+        n_samples: int,
+        n_simulations: int,
+        cvr: float,
+        mde_grid: List[float],
+        reward_avg: float,
+        reward_std: float,
+        alpha: float = 0.05,
+        beta: float = 0.2,
+        seed: int = 0,
+        engine: str = "vectorized",
+        executor: Optional[Executor] = None,
+) -> Tuple[float, float]:
+    """Select MDE with binary search, see select_mde."""
+    grid = sorted(mde_grid)
+    cpc_avg, cpc_std = cpc_moments(cvr, reward_avg, reward_std)
+    start = int(np.searchsorted(grid, calculate_mde(cpc_std, n_samples, alpha, beta) / cpc_avg))
+
+    def powerful(i: int) -> bool:
+        return error_rate_bound(
+            n_simulations, n_samples, cvr, cvr * (1 + grid[i]), reward_avg, reward_std, alpha, beta, True, seed,
+            engine=engine, executor=executor,
+        )[1]
+
+    def type_2_error(i: int) -> float:
+        if i not in type_2_errors:
+            type_2_errors[i] = (n_simulations - count_rejections(
+                n_simulations, n_samples, cvr, cvr * (1 + grid[i]), reward_avg, reward_std, alpha, engine, seed,
+                executor,
+            )) / n_simulations
+        return type_2_errors[i]
+
+    type_2_errors = {}
+    first = first_passing(len(grid), start, powerful)
+    if first is not None:
+        # Early stopping may be wrong near beta, grid points from the found one
+        # are checked on full simulations, the first passing one is taken as in grid method
+        for i in range(lowest_candidate(len(grid), first, type_2_error, beta, n_simulations), len(grid)):
+            if type_2_error(i) <= beta:
+                return grid[i], type_2_error(i)
+
+    raise RuntimeError(
+        "Can't find MDE. "
+        f"Largest MDE: {grid[-1]}. "
+        "Make sure that the grid is big enough."
+    )
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from statistical_test import select_mde, select_sample_size
+
+
+MDE_GRID = np.round(np.arange(0.01, 0.41, 0.01), 2).tolist()
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("n_samples", [2_000, 10_000])
+def test_search_mde_agrees_with_grid(seed: int, n_samples: int) -> None:
+    args = (n_samples, 2_000, 0.1, MDE_GRID, 2.0, 1.0)
+    grid_mde, grid_error = select_mde(*args, seed=seed, method="grid")
+    search_mde, search_error = select_mde(*args, seed=seed, method="search")
+
+    assert search_error <= 0.2
+    assert (search_mde, search_error) == (grid_mde, grid_error)
+
+
+SAMPLE_SIZE_GRID = list(range(250, 40_001, 250))
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("mde", [0.1, 0.15, 0.2, 0.3])
+def test_search_sample_size_agrees_with_grid(seed: int, mde: float) -> None:
+    args = (SAMPLE_SIZE_GRID, 2_000, 0.1, mde, 2.0, 1.0)
+    grid_result = select_sample_size(*args, seed=seed, method="grid")
+    search_result = select_sample_size(*args, seed=seed, method="search")
+
+    assert search_result[1] <= 0.05 and search_result[2] <= 0.2
+    assert search_result == grid_result